@@ -0,0 +1,167 @@
+'''
+    Microbenchmarks of EatingManager hot paths over synthetic datasets.
+
+    Usage:
+        python benchmarks/bench_hot_paths.py [--groups 10 100 1000 10000] [--foods 100 1000 10000 50000]
+                                             [--iterations 2000] [--output result.json]
+
+    For every dataset, half of the foods go to the basic menu and the rest are spread over the groups.
+    Every operation is timed call by call, and ops/sec with p50/p99 latency are reported as JSON,
+    so that results of releases can be compared.
+'''
+import argparse
+import asyncio
+import json
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Union
+
+ROOT: Path = Path(__file__).resolve().parent.parent
+RESOURCE: Path = ROOT / "nonebot_plugin_what2eat" / "resource"
+
+
+def make_eating(groups: int, foods: int, users: int = 5) -> Dict[str, Any]:
+    basic: int = max(1, foods // 2)
+    per_group: int = max(1, (foods - basic) // groups)
+
+    return {
+        "version": 0,
+        "basic_food": [f"基础菜{i}" for i in range(basic)],
+        "group_food": {str(g): [f"群{g}菜{i}" for i in range(per_group)] for g in range(groups)},
+        "count": {str(g): {str(u): 0 for u in range(users)} for g in range(groups)}
+    }
+
+
+def make_dataset(path: Path, groups: int, foods: int, users: int = 5) -> None:
+    with (path / "eating.json").open("w", encoding="utf-8") as f:
+        json.dump(make_eating(groups, foods, users), f, ensure_ascii=False)
+
+
+def summarize(name: str, groups: int, foods: int, samples: List[int]) -> Dict[str, Union[str, int, float]]:
+    samples.sort()
+    total: float = sum(samples) / 1e9
+
+    return {
+        "op": name,
+        "groups": groups,
+        "foods": foods,
+        "n": len(samples),
+        "ops_per_sec": round(len(samples) / total, 1) if total > 0 else None,
+        "p50_us": round(samples[len(samples) // 2] / 1e3, 2),
+        "p99_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] / 1e3, 2),
+        "mean_us": round(statistics.mean(samples) / 1e3, 2)
+    }
+
+
+async def measure(func: Callable[[int], Union[Any, Awaitable[Any]]], iterations: int) -> List[int]:
+    samples: List[int] = []
+    for i in range(iterations):
+        start: int = time.perf_counter_ns()
+        res = func(i)
+        if asyncio.iscoroutine(res):
+            await res
+
+        samples.append(time.perf_counter_ns() - start)
+
+    return samples
+
+
+async def bench_dataset(data_path: Path, groups: int, foods: int, iterations: int) -> List[Dict[str, Any]]:
+    from nonebot.adapters.onebot.v11 import GroupMessageEvent
+
+    from nonebot_plugin_what2eat.data_source import eating_manager
+    from nonebot_plugin_what2eat.utils import SearchLoc
+
+    await eating_manager.close()
+    make_dataset(data_path, groups, foods)
+    await eating_manager.load()
+
+    def event(i: int) -> GroupMessageEvent:
+        # Stub events, only the ids are used
+        return GroupMessageEvent.construct(group_id=random.randrange(groups), user_id=i % 1000, self_id=0)
+
+    basic: int = max(1, foods // 2)
+    results: List[Dict[str, Any]] = []
+    cases: Dict[str, Callable[[int], Any]] = {
+        "get2eat": lambda i: eating_manager.get2eat(event(i)),
+        "get2drink": lambda i: eating_manager.get2drink(event(i)),
+        "pick_one_drink": lambda i: eating_manager.pick_one_drink(),
+        # As get2eat and pick_one_drink pick with WHAT2EAT_NO_REPEAT="user"
+        "shuffle_bag_pick": lambda i: eating_manager._bags.pick(
+            f"{i % groups}:{i % 1000}", eating_manager._get_pool(str(i % groups))),
+        "pick_one_drink_no_repeat": lambda i: eating_manager.pick_one_drink(f"{i % groups}:{i % 1000}"),
+        "_is_food_exists": lambda i: eating_manager._is_food_exists(
+            f"基础菜{random.randrange(basic)}", SearchLoc.IN_GLOBAL, str(random.randrange(groups))),
+        "add_group_food": lambda i: eating_manager.add_group_food(
+            GroupMessageEvent.construct(group_id=i % groups, user_id=1, self_id=0), f"新菜{i}"),
+        "remove_food": lambda i: eating_manager.remove_food(
+            GroupMessageEvent.construct(group_id=i % groups, user_id=1, self_id=0), f"新菜{i}"),
+        "show_group_menu": lambda i: eating_manager.show_group_menu(str(random.randrange(groups)))
+    }
+
+    for name, func in cases.items():
+        samples: List[int] = await measure(func, iterations)
+        results.append(summarize(name, groups, foods, samples))
+        print(json.dumps(results[-1], ensure_ascii=False), file=sys.stderr)
+
+    await eating_manager.flush()
+
+    return results
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    results: List[Dict[str, Any]] = []
+    for groups in args.groups:
+        for foods in args.foods:
+            results += await bench_dataset(args.data_path, groups, foods, args.iterations)
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "iterations": args.iterations,
+        "results": results
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, nargs="+",
+                        default=[10, 100, 1000, 10000])
+    parser.add_argument("--foods", type=int, nargs="+",
+                        default=[100, 1000, 10000, 50000])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--output", type=Path, default=None)
+    args = parser.parse_args()
+
+    args.data_path = Path(tempfile.mkdtemp(prefix="what2eat-bench-"))
+    for name in ("drinks.json", "greetings.json"):
+        shutil.copy(RESOURCE / name, args.data_path / name)
+
+    make_dataset(args.data_path, 1, 1)
+
+    import nonebot
+
+    nonebot.init(driver="~none", what2eat_path=str(args.data_path),
+                 eating_limit=1 << 30, log_level="WARNING")
+    sys.path.insert(0, str(ROOT))
+    nonebot.load_plugin("nonebot_plugin_apscheduler")
+    nonebot.load_plugin("nonebot_plugin_what2eat")
+
+    try:
+        report: Dict[str, Any] = asyncio.run(main(args))
+    finally:
+        shutil.rmtree(args.data_path, ignore_errors=True)
+
+    text: str = json.dumps(report, ensure_ascii=False, indent=4)
+    if args.output is None:
+        print(text)
+    else:
+        args.output.write_text(text, encoding="utf-8")
@@ -0,0 +1,121 @@
+'''
+    Benchmarks of the serializers selectable by WHAT2EAT_SERIALIZER and WHAT2EAT_COMPACT.
+
+    Usage:
+        python benchmarks/bench_serializers.py [--groups 100 10000] [--foods 1000 50000]
+                                               [--repeats 20] [--output result.json]
+
+    Datasets are the resource files shipped with the plugin, and synthetic eating.json of every
+    groups x foods as bench_hot_paths.py makes. For every serializer installed, the median time of
+    encoding, decoding, saving (encode + atomic write with fsync) and loading (read + decode)
+    is reported as JSON, with the size of the file.
+'''
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+from bench_hot_paths import RESOURCE, ROOT, make_eating
+
+# (serializer, compact) as WHAT2EAT_SERIALIZER and WHAT2EAT_COMPACT
+CONFIGS: List[Tuple[str, bool]] = [
+    ("json", False), ("json", True), ("orjson", False), ("orjson", True), ("msgpack", True)]
+
+
+def median_ms(func: Callable[[], Any], repeats: int) -> float:
+    samples: List[int] = []
+    for _ in range(repeats):
+        start: int = time.perf_counter_ns()
+        func()
+        samples.append(time.perf_counter_ns() - start)
+
+    return round(statistics.median(samples) / 1e6, 3)
+
+
+def bench_data(name: str, _data: Any, data_path: Path, repeats: int) -> List[Dict[str, Any]]:
+    from nonebot_plugin_what2eat import serializer
+    from nonebot_plugin_what2eat.utils import load_json, save_data
+
+    results: List[Dict[str, Any]] = []
+    for config, compact in CONFIGS:
+        if config != "json" and getattr(serializer, config) is None:
+            print(f"{config} is not installed, skipped", file=sys.stderr)
+            continue
+
+        serializer.configure(config, compact)
+        codec: serializer.Serializer = serializer.data_serializer
+        _raw: bytes = codec.dumps(_data)
+        _file: Path = serializer.data_file(data_path / name)
+
+        results.append({
+            "data": name,
+            "serializer": config,
+            "compact": compact,
+            "bytes": len(_raw),
+            "dump_ms": median_ms(lambda: codec.dumps(_data), repeats),
+            "parse_ms": median_ms(lambda: codec.loads(_raw), repeats),
+            "save_ms": median_ms(lambda: save_data(data_path / name, _data), repeats),
+            "load_ms": median_ms(lambda: load_json(_file), repeats)
+        })
+        print(json.dumps(results[-1], ensure_ascii=False), file=sys.stderr)
+
+        _file.unlink()
+
+    return results
+
+
+def main(args: argparse.Namespace) -> Dict[str, Any]:
+    datasets: List[Tuple[str, Any]] = [
+        (name, json.loads((RESOURCE / name).read_text(encoding="utf-8")))
+        for name in ("eating.json", "drinks.json", "greetings.json")]
+    datasets += [(f"eating-{groups}g-{foods}f.json", make_eating(groups, foods))
+                 for groups in args.groups for foods in args.foods]
+
+    results: List[Dict[str, Any]] = []
+    for name, _data in datasets:
+        results += bench_data(name, _data, args.data_path, args.repeats)
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "repeats": args.repeats,
+        "results": results
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, nargs="+", default=[100, 10000])
+    parser.add_argument("--foods", type=int, nargs="+", default=[1000, 50000])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--output", type=Path, default=None)
+    args = parser.parse_args()
+
+    args.data_path = Path(tempfile.mkdtemp(prefix="what2eat-bench-"))
+
+    import nonebot
+
+    nonebot.init(driver="~none", what2eat_path=str(
+        args.data_path), log_level="WARNING")
+    sys.path.insert(0, str(ROOT))
+    nonebot.load_plugin("nonebot_plugin_apscheduler")
+    nonebot.load_plugin("nonebot_plugin_what2eat")
+
+    try:
+        report: Dict[str, Any] = main(args)
+    finally:
+        shutil.rmtree(args.data_path, ignore_errors=True)
+
+    text: str = json.dumps(report, ensure_ascii=False, indent=4)
+    if args.output is None:
+        print(text)
+    else:
+        args.output.write_text(text, encoding="utf-8")
@@ -0,0 +1,184 @@
+'''
+    End-to-end check of downloads against a local stub of the resource repo.
+
+    Usage:
+        python benchmarks/check_downloads.py
+
+    An http.server on 127.0.0.1 stands in for WHAT2EAT_RESOURCE_URL. It checks that Downloader.get
+    returns 200 and 304 responses, gives up on 404 at once and on 503 after every retry,
+    that fetch_resource(conditional=True) sends the validators committed before and returns None
+    when not modified, and that the validators file holds both resources once both are committed.
+    Exits with 1 if any check fails.
+'''
+import asyncio
+import json
+import shutil
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from bench_hot_paths import RESOURCE, ROOT
+
+RETRIES: int = 3
+ETAG: str = '"eating-v1"'
+LAST_MODIFIED: str = "Sun, 18 Oct 2026 00:00:00 GMT"
+EATING: Dict[str, Any] = {"version": 1.0, "basic_food": ["测试菜"]}
+DRINKS: Dict[str, Any] = {"version": 1.0, "测试品牌": ["测试饮品"]}
+
+
+class StubRepo(ThreadingHTTPServer):
+    '''
+        /eating.json is validated by ETag, /drinks.json by Last-Modified,
+        /flaky.json fails with 503 once, /down.json always fails with 503, anything else is 404.
+        Paths and headers of the requests are recorded in hits.
+    '''
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.hits: List[Tuple[str, Dict[str, str]]] = []
+        self.flaky: int = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/"
+
+    def count(self, path: str) -> int:
+        return sum(hit[0] == path for hit in self.hits)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server: StubRepo
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def reply(self, status: int, headers: Optional[Dict[str, str]] = None, body: Optional[Dict[str, Any]] = None) -> None:
+        _data: bytes = b"" if body is None else json.dumps(
+            body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+
+        self.send_header("Content-Length", str(len(_data)))
+        self.end_headers()
+        self.wfile.write(_data)
+
+    def do_GET(self) -> None:
+        self.server.hits.append((self.path, dict(self.headers)))
+
+        if self.path == "/eating.json":
+            if self.headers.get("If-None-Match") == ETAG:
+                self.reply(304, {"ETag": ETAG})
+            else:
+                self.reply(200, {"ETag": ETAG}, EATING)
+        elif self.path == "/drinks.json":
+            if self.headers.get("If-Modified-Since") == LAST_MODIFIED:
+                self.reply(304, {"Last-Modified": LAST_MODIFIED})
+            else:
+                self.reply(200, {"Last-Modified": LAST_MODIFIED}, DRINKS)
+        elif self.path == "/flaky.json":
+            self.server.flaky += 1
+            if self.server.flaky == 1:
+                self.reply(503)
+            else:
+                self.reply(200, {}, EATING)
+        elif self.path == "/down.json":
+            self.reply(503)
+        else:
+            self.reply(404)
+
+
+failures: List[str] = []
+
+
+def check(name: str, ok: bool) -> None:
+    print(f"{'ok' if ok else 'FAILED'}: {name}")
+    if not ok:
+        failures.append(name)
+
+
+async def main(repo: StubRepo, data_path: Path) -> None:
+    from nonebot_plugin_what2eat.config import (commit_resource, downloader,
+                                                fetch_resource)
+
+    validators_file: Path = data_path / "what2eat.validators.json"
+
+    # Downloader.get
+    response = await downloader.get(repo.url + "eating.json")
+    check("200 OK", response is not None and response.status_code ==
+          200 and response.json() == EATING)
+
+    response = await downloader.get(repo.url + "eating.json", {"If-None-Match": ETAG})
+    check("304 Not Modified", response is not None and response.status_code == 304)
+
+    response = await downloader.get(repo.url + "missing.json")
+    check("404 is not retried", response is None and repo.count("/missing.json") == 1)
+
+    response = await downloader.get(repo.url + "down.json")
+    check(f"503 is retried {RETRIES} times", response is None and repo.count(
+        "/down.json") == RETRIES)
+
+    response = await downloader.get(repo.url + "flaky.json")
+    check("503 then 200 OK", response is not None and response.status_code ==
+          200 and repo.count("/flaky.json") == 2)
+
+    # fetch_resource(conditional=True), nothing is validated before commit
+    eating = await fetch_resource("eating.json", conditional=True)
+    drinks = await fetch_resource("drinks.json", conditional=True)
+    check("fetch_resource returns resources",
+          eating == EATING and drinks == DRINKS)
+    check("validators are not saved before commit", not validators_file.exists())
+
+    await fetch_resource("eating.json", conditional=True)
+    check("uncommitted validators are not sent",
+          "If-None-Match" not in repo.hits[-1][1])
+
+    await asyncio.gather(commit_resource("eating.json"), commit_resource("drinks.json"))
+    saved: Dict[str, Dict[str, str]] = json.loads(
+        validators_file.read_text(encoding="utf-8"))
+    check("validators of both resources are saved", saved == {
+        repo.url + "eating.json": {"etag": ETAG},
+        repo.url + "drinks.json": {"last_modified": LAST_MODIFIED}
+    })
+
+    eating = await fetch_resource("eating.json", conditional=True)
+    check("conditional fetch by ETag is not modified",
+          eating is None and repo.hits[-1][1].get("If-None-Match") == ETAG)
+
+    drinks = await fetch_resource("drinks.json", conditional=True)
+    check("conditional fetch by Last-Modified is not modified",
+          drinks is None and repo.hits[-1][1].get("If-Modified-Since") == LAST_MODIFIED)
+
+    drinks = await fetch_resource("drinks.json")
+    check("unconditional fetch is 200 OK", drinks == DRINKS)
+
+    await downloader.shutdown()
+
+
+if __name__ == "__main__":
+    repo = StubRepo()
+    threading.Thread(target=repo.serve_forever, daemon=True).start()
+
+    data_path = Path(tempfile.mkdtemp(prefix="what2eat-check-"))
+    for name in ("eating.json", "drinks.json", "greetings.json"):
+        shutil.copy(RESOURCE / name, data_path / name)
+
+    import nonebot
+
+    nonebot.init(driver="~none", what2eat_path=str(data_path), what2eat_resource_url=repo.url,
+                 what2eat_http_retries=RETRIES, what2eat_http_backoff=0.01, log_level="WARNING")
+    sys.path.insert(0, str(ROOT))
+    nonebot.load_plugin("nonebot_plugin_apscheduler")
+    nonebot.load_plugin("nonebot_plugin_what2eat")
+
+    try:
+        asyncio.run(main(repo, data_path))
+    finally:
+        repo.shutdown()
+        shutil.rmtree(data_path, ignore_errors=True)
+
+    print(f"{len(failures)} failed" if failures else "All passed")
+    sys.exit(1 if failures else 0)
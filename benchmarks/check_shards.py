@@ -0,0 +1,150 @@
+'''
+    Check of the shard storage with more groups active than WHAT2EAT_SHARD_CACHE_SIZE holds.
+
+    Usage:
+        python benchmarks/check_shards.py [--rounds 20]
+
+    Groups evicted while a flush is writing other shards must still be written: foods are added to
+    two groups, a flush is started, and two other groups are asked at once so that both are evicted.
+    Then concurrent commands over many groups, with flushes in between, run with small caches.
+    After reloading, every food added and every count must be there. Exits with 1 if any is lost.
+'''
+import argparse
+import asyncio
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List
+
+from bench_hot_paths import RESOURCE, ROOT, make_dataset
+
+failures: List[str] = []
+
+
+def check(name: str, ok: bool) -> None:
+    print(f"{'ok' if ok else 'FAILED'}: {name}")
+    if not ok:
+        failures.append(name)
+
+
+def event(gid: int, uid: int = 1) -> Any:
+    from nonebot.adapters.onebot.v11 import GroupMessageEvent
+
+    # Stub events, only the ids are used
+    return GroupMessageEvent.construct(group_id=gid, user_id=uid, self_id=0)
+
+
+async def reload_group(gid: int) -> Dict[str, Any]:
+    from nonebot_plugin_what2eat.data_source import eating_manager
+
+    await eating_manager._ensure_group(str(gid))
+
+    return {
+        "food": list(eating_manager._eating["group_food"].get(str(gid), [])),
+        "count": dict(eating_manager._eating["count"].get(str(gid), {}))
+    }
+
+
+async def check_flush_eviction(rounds: int) -> None:
+    '''
+        Foods of groups 1 and 2 are dirty when the flush starts, groups 3 and 4 evict them meanwhile
+    '''
+    from nonebot_plugin_what2eat.config import what2eat_config
+    from nonebot_plugin_what2eat.data_source import eating_manager
+
+    what2eat_config.what2eat_shard_cache_size = 2
+    lost: int = 0
+    for r in range(rounds):
+        base: int = 1000 + r * 10
+        await eating_manager.load()
+        await eating_manager.add_group_food(event(base + 1), f"flush{r}a")
+        await eating_manager.add_group_food(event(base + 2), f"flush{r}b")
+
+        flush: asyncio.Task = asyncio.create_task(eating_manager.flush())
+        await asyncio.gather(eating_manager.get2eat(event(base + 3)), eating_manager.get2eat(event(base + 4)))
+        await flush
+        await eating_manager.close()
+
+        await eating_manager.load()
+        lost += f"flush{r}a" not in (await reload_group(base + 1))["food"]
+        lost += f"flush{r}b" not in (await reload_group(base + 2))["food"]
+        await eating_manager.close()
+
+    check(
+        f"groups evicted during a flush are written, {lost} foods lost in {rounds} rounds", lost == 0)
+
+
+async def check_concurrent(cache_size: int, workers: int = 8, commands: int = 30) -> None:
+    '''
+        Every worker adds foods to and asks its own group, with flushes in between
+    '''
+    from nonebot_plugin_what2eat.config import what2eat_config
+    from nonebot_plugin_what2eat.data_source import eating_manager
+
+    what2eat_config.what2eat_shard_cache_size = cache_size
+    base: int = 10000 * cache_size
+    await eating_manager.load()
+
+    async def worker(w: int) -> None:
+        for i in range(commands):
+            await eating_manager.add_group_food(event(base + w), f"food{w}-{i}")
+            await eating_manager.get2eat(event(base + w, uid=w))
+            if i % 7 == w % 7:
+                await eating_manager.flush()
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*(worker(w) for w in range(workers))), 60)
+    except asyncio.TimeoutError:
+        check(
+            f"cache size {cache_size}: {workers} groups x {commands} commands finish", False)
+        await eating_manager.close()
+        return
+
+    await eating_manager.close()
+    await eating_manager.load()
+    foods: int = 0
+    counts: int = 0
+    for w in range(workers):
+        group: Dict[str, Any] = await reload_group(base + w)
+        foods += sum(f"food{w}-{i}" in group["food"] for i in range(commands))
+        counts += group["count"].get(str(w), [0])[0]
+
+    await eating_manager.close()
+    check(f"cache size {cache_size}: {foods}/{workers * commands} foods and "
+          f"{counts}/{workers * commands} counts kept", foods == counts == workers * commands)
+
+
+async def main(args: argparse.Namespace) -> None:
+    await check_flush_eviction(args.rounds)
+    for cache_size in (1, 2, 4, 16):
+        await check_concurrent(cache_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    data_path = Path(tempfile.mkdtemp(prefix="what2eat-check-"))
+    for name in ("drinks.json", "greetings.json"):
+        shutil.copy(RESOURCE / name, data_path / name)
+
+    make_dataset(data_path, 1, 100)
+
+    import nonebot
+
+    nonebot.init(driver="~none", what2eat_path=str(data_path), what2eat_storage="shard",
+                 eating_limit=1 << 30, log_level="WARNING")
+    sys.path.insert(0, str(ROOT))
+    nonebot.load_plugin("nonebot_plugin_apscheduler")
+    nonebot.load_plugin("nonebot_plugin_what2eat")
+
+    try:
+        asyncio.run(main(args))
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+
+    print(f"{len(failures)} failed" if failures else "All passed")
+    sys.exit(1 if failures else 0)
@@ -1,22 +1,33 @@
-from typing import Any, Coroutine, List
-
-from nonebot import logger, on_command, on_regex, require
-from nonebot.adapters.onebot.v11 import (GROUP, GROUP_ADMIN, GROUP_OWNER, Bot,
-                                         GroupMessageEvent, Message,
+import asyncio
+import time
+from contextlib import suppress
+from pathlib import Path
+from typing import Any, Coroutine, Dict, List, Optional, Type
+
+from nonebot import (get_driver, logger, on_command, on_notice, on_regex,
+                     require)
+from nonebot.adapters.onebot.v11 import (GROUP, GROUP_ADMIN, GROUP_OWNER,
+                                         ActionFailed, Bot, GroupMessageEvent,
+                                         GroupUploadNoticeEvent, Message,
                                          MessageEvent, MessageSegment)
 from nonebot.matcher import Matcher
+from nonebot.message import run_postprocessor, run_preprocessor
 from nonebot.params import Arg, ArgStr, CommandArg, Depends, RegexMatched
 from nonebot.permission import SUPERUSER
 from nonebot.plugin import PluginMetadata
 from nonebot.typing import T_State
 from nonebot_plugin_apscheduler import scheduler
 
+from .config import (DownloadError, commit_resource, downloader, drinks_update,
+                     fetch_resource, what2eat_config)
 from .data_source import eating_manager
-from .utils import Meals, save_cq_image
+from .menu import IMPORT_LIMIT, IMPORT_MAX_BYTES, parse_foods, parse_menu_file
+from .metrics import Exporter, handler_seconds, registry
+from .utils import Meals
 
 require("nonebot_plugin_apscheduler")
 
-__what2eat_version__ = "v0.3.6"
+__what2eat_version__ = "v0.4.0"
 __what2eat_usages__ = f'''
 今天吃什么？ {__what2eat_version__}
 [xx吃xx]    问bot吃什么
@@ -24,10 +35,16 @@ __what2eat_usages__ = f'''
 [添加 xx]   添加菜品至群菜单
 [移除 xx]   从菜单移除菜品
 [加菜 xx]   添加菜品至基础菜单
+[批量添加/批量加菜] 每行一道，批量添加至群/基础菜单
+[导出群菜单/导出基础菜单] 导出菜单为群文件，修改后上传即可导入
 [菜单]        查看群菜单
 [基础菜单] 查看基础菜单
+[搜索 关键词] 搜索菜单中的菜品
 [开启/关闭小助手] 开启/关闭吃饭小助手
-[添加/删除问候 时段 问候语] 添加/删除吃饭小助手问候语'''.strip()
+[添加/删除问候 时段 问候语] 添加/删除吃饭小助手问候语
+[吃什么状态] 查看插件运行指标
+[导出菜单] 导出可读的菜单与问候语
+[清理图片] 删除未被引用的图片'''.strip()
 
 __plugin_meta__ = PluginMetadata(
     name="今天吃什么？",
@@ -48,9 +65,18 @@ group_add = on_command("添加", permission=SUPERUSER |
 group_remove = on_command("移除", permission=SUPERUSER |
                           GROUP_ADMIN | GROUP_OWNER, priority=15, block=True)
 basic_add = on_command("加菜", permission=SUPERUSER, priority=15, block=True)
+batch_group_add = on_command("批量添加", permission=SUPERUSER |
+                             GROUP_ADMIN | GROUP_OWNER, priority=15, block=True)
+batch_basic_add = on_command(
+    "批量加菜", permission=SUPERUSER, priority=15, block=True)
+export_group_menu = on_command("导出群菜单", permission=SUPERUSER |
+                               GROUP_ADMIN | GROUP_OWNER, priority=15, block=True)
+export_basic_menu = on_command(
+    "导出基础菜单", permission=SUPERUSER, priority=15, block=True)
 show_group_menu = on_command(
     "菜单", aliases={"群菜单", "查看菜单"}, permission=GROUP, priority=15, block=True)
 show_basic_menu = on_command("基础菜单", permission=GROUP, priority=15, block=True)
+search_food = on_command("搜索", aliases={"搜索菜品"}, priority=15, block=True)
 
 greeting_on = on_command("开启小助手", aliases={
                          "启用小助手"}, permission=SUPERUSER | GROUP_ADMIN | GROUP_OWNER, priority=12, block=True)
@@ -60,6 +86,12 @@ add_greeting = on_command("添加问候", aliases={
                           "添加问候语"}, permission=SUPERUSER | GROUP_ADMIN | GROUP_OWNER, priority=12, block=True)
 remove_greeting = on_command("删除问候", aliases={
                              "删除问候语", "移除问候", "移除问候语"}, permission=SUPERUSER | GROUP_ADMIN | GROUP_OWNER, priority=12, block=True)
+show_metrics = on_command(
+    "吃什么状态", permission=SUPERUSER, priority=12, block=True)
+export_data = on_command(
+    "导出菜单", aliases={"导出数据"}, permission=SUPERUSER, priority=12, block=True)
+sweep_images = on_command(
+    "清理图片", permission=SUPERUSER, priority=12, block=True)
 
 
 @what2eat.handle()
@@ -67,7 +99,7 @@ async def _(event: MessageEvent, args: str = RegexMatched()):
     if args[-2:] == "帮助":
         await what2eat.finish(__what2eat_usages__)
 
-    msg = eating_manager.get2eat(event)
+    msg = await eating_manager.get2eat(event)
     await what2eat.finish(msg)
 
 
@@ -76,10 +108,13 @@ async def _(event: MessageEvent, args: str = RegexMatched()):
     if args[-2:] == "帮助":
         await what2drink.finish(__what2eat_usages__)
 
-    msg = eating_manager.get2drink(event)
+    msg = await eating_manager.get2drink(event)
     await what2drink.finish(msg)
 
 
+IMAGE_QUOTA_MSG: str = "图片存储空间已满，请联系超管[清理图片]后再添加带图的菜品~"
+
+
 @group_add.handle()
 async def _(event: GroupMessageEvent, args: Message = CommandArg()):
     args_str: List[str] = args.extract_plain_text().strip().split()
@@ -89,10 +124,11 @@ async def _(event: GroupMessageEvent, args: Message = CommandArg()):
         await group_add.finish("添加菜品参数错误~")
 
     # If image included, save it, return the path in string
-    await save_cq_image(args, eating_manager._img_dir)
+    if not await eating_manager._images.save_cq_image(args):
+        await group_add.finish(IMAGE_QUOTA_MSG)
 
     # Record the whole string, including the args after transfering
-    msg: str = eating_manager.add_group_food(event, str(args))
+    msg: str = await eating_manager.add_group_food(event, str(args))
 
     if "[CQ:image" in str(args):
         await group_add.finish(args.append(MessageSegment.text(" " + msg)))
@@ -109,8 +145,9 @@ async def _(args: Message = CommandArg()):
         await group_add.finish("添加菜品参数错误~")
 
     # The same as above
-    await save_cq_image(args, eating_manager._img_dir)
-    msg: str = eating_manager.add_basic_food(str(args))
+    if not await eating_manager._images.save_cq_image(args):
+        await basic_add.finish(IMAGE_QUOTA_MSG)
+    msg: str = await eating_manager.add_basic_food(str(args))
 
     if "[CQ:image" in str(args):
         await group_add.finish(args.append(MessageSegment.text(" " + msg)))
@@ -118,6 +155,116 @@ async def _(args: Message = CommandArg()):
         await group_add.finish(args.append(MessageSegment.text(msg)))
 
 
+def import_report(menu: str, total: int, added: int, skipped: int, invalid: int) -> str:
+    msg: str = f"已导入{added}道菜品至{menu}~"
+    if skipped > 0:
+        msg += f"\n{skipped}道已在菜单中或重复，已跳过"
+    if invalid > 0:
+        msg += f"\n{invalid}行无法识别，每行应为一道菜品"
+    if total > IMPORT_LIMIT:
+        msg += f"\n单次最多导入{IMPORT_LIMIT}道，超出部分未导入"
+
+    return msg
+
+
+@batch_group_add.handle()
+async def _(event: GroupMessageEvent, args: Message = CommandArg()):
+    if not await eating_manager._images.save_cq_image(args):
+        await batch_group_add.finish(IMAGE_QUOTA_MSG)
+
+    foods, invalid = parse_foods(
+        str(args).splitlines(), eating_manager._images.stored_food)
+    if not foods:
+        await batch_group_add.finish("还没输入你要添加的菜品呢，每行一道~")
+
+    added, skipped = await eating_manager.import_foods(str(event.group_id), foods)
+    await batch_group_add.finish(import_report("群特色菜单", len(foods), added, skipped, invalid))
+
+
+@batch_basic_add.handle()
+async def _(args: Message = CommandArg()):
+    if not await eating_manager._images.save_cq_image(args):
+        await batch_basic_add.finish(IMAGE_QUOTA_MSG)
+
+    foods, invalid = parse_foods(
+        str(args).splitlines(), eating_manager._images.stored_food)
+    if not foods:
+        await batch_basic_add.finish("还没输入你要添加的菜品呢，每行一道~")
+
+    added, skipped = await eating_manager.import_foods(None, foods)
+    await batch_basic_add.finish(import_report("基础菜单", len(foods), added, skipped, invalid))
+
+
+async def is_menu_file(bot: Bot, event: GroupUploadNoticeEvent) -> bool:
+    '''
+        A text or JSON file whose name contains "菜单", not uploaded by the bot itself, e.g. an export
+    '''
+    return "菜单" in event.file.name and event.file.name.lower().endswith((".txt", ".json")) \
+        and str(event.user_id) != bot.self_id
+
+
+menu_upload = on_notice(rule=is_menu_file, priority=15, block=True)
+
+
+@menu_upload.handle()
+async def _(bot: Bot, event: GroupUploadNoticeEvent):
+    # Files named "基础菜单" go to the basic menu, others to the group's menu, with the same permissions as adding
+    basic: bool = "基础菜单" in event.file.name
+    if not await SUPERUSER(bot, event):
+        if basic:
+            await menu_upload.finish()
+
+        member: Dict[str, Any] = await bot.get_group_member_info(group_id=event.group_id, user_id=event.user_id)
+        if member.get("role") not in ("admin", "owner"):
+            await menu_upload.finish()
+
+    if event.file.size > IMPORT_MAX_BYTES:
+        await menu_upload.finish(f"菜单文件不能超过{IMPORT_MAX_BYTES >> 10}KB，请分成多个文件上传~")
+
+    url: Optional[str] = getattr(event.file, "url", None)
+    if not url:
+        try:
+            url = (await bot.call_api("get_group_file_url", group_id=event.group_id,
+                                      file_id=event.file.id, busid=event.file.busid))["url"]
+        except ActionFailed:
+            await menu_upload.finish("获取菜单文件失败~")
+
+    data: Optional[bytes] = await downloader.get_bytes(url)
+    if not data:
+        await menu_upload.finish("下载菜单文件失败，请稍后重新上传~")
+
+    foods, invalid = parse_menu_file(
+        event.file.name, data, eating_manager._images.stored_food)
+    added, skipped = await eating_manager.import_foods(None if basic else str(event.group_id), foods)
+    await menu_upload.finish(import_report("基础菜单" if basic else "群特色菜单", len(foods), added, skipped, invalid))
+
+
+async def upload_menu_file(bot: Bot, event: GroupMessageEvent, export_file: Path, n_foods: int) -> str:
+    try:
+        await bot.call_api("upload_group_file", group_id=event.group_id,
+                           file=str(export_file.resolve()), name=export_file.name)
+    except ActionFailed:
+        return f"已导出{n_foods}道菜品至 {export_file}，但上传群文件失败~"
+
+    return f"已导出{n_foods}道菜品为群文件 {export_file.name}，修改后上传即可导入~"
+
+
+@export_group_menu.handle()
+async def _(bot: Bot, event: GroupMessageEvent):
+    gid: str = str(event.group_id)
+    export_file: Path = what2eat_config.what2eat_path / \
+        "export" / f"群菜单_{gid}.txt"
+    n_foods: int = await eating_manager.export_menu(gid, export_file)
+    await export_group_menu.finish(await upload_menu_file(bot, event, export_file, n_foods))
+
+
+@export_basic_menu.handle()
+async def _(bot: Bot, event: GroupMessageEvent):
+    export_file: Path = what2eat_config.what2eat_path / "export" / "基础菜单.txt"
+    n_foods: int = await eating_manager.export_menu(None, export_file)
+    await export_basic_menu.finish(await upload_menu_file(bot, event, export_file, n_foods))
+
+
 @group_remove.handle()
 async def _(event: GroupMessageEvent, args: Message = CommandArg()):
     args: List[str] = args.extract_plain_text().strip().split()
@@ -126,41 +273,59 @@ async def _(event: GroupMessageEvent, args: Message = CommandArg()):
     elif len(args) > 1:
         await group_remove.finish("移除菜品参数错误~")
 
-    msg: MessageSegment = eating_manager.remove_food(event, args[0])
+    msg: MessageSegment = await eating_manager.remove_food(event, args[0])
 
     await group_remove.finish(MessageSegment.text(msg))
 
 
+async def send_forward_menu(bot: Bot, event: GroupMessageEvent, pages: List[Message]) -> None:
+    '''
+        Send the menu as a forward message, one node per page
+    '''
+    nickname: str = list(bot.config.nickname)[0]
+    await bot.call_api("send_group_forward_msg", group_id=event.group_id,
+                       messages=[MessageSegment.node_custom(int(bot.self_id), nickname, page) for page in pages])
+
+
 @show_group_menu.handle()
 async def _(bot: Bot, matcher: Matcher, event: GroupMessageEvent):
     gid = str(event.group_id)
-    is_too_many_lines, msg = eating_manager.show_group_menu(gid)
+    is_too_many_lines, pages = await eating_manager.show_group_menu(gid)
     if is_too_many_lines:
-        await bot.call_api("send_group_forward_msg", group_id=event.group_id, messages=MessageSegment.node_custom(int(bot.self_id), list(bot.config.nickname)[0], msg))
+        await send_forward_menu(bot, event, pages)
     else:
-        await matcher.finish(msg)
+        await matcher.finish(pages[0])
 
 
 @show_basic_menu.handle()
 async def _(bot: Bot, matcher: Matcher, event: GroupMessageEvent):
-    is_too_many_lines, msg = eating_manager.show_basic_menu()
+    is_too_many_lines, pages = eating_manager.show_basic_menu()
     if is_too_many_lines:
-        await bot.call_api("send_group_forward_msg", group_id=event.group_id, messages=MessageSegment.node_custom(int(bot.self_id), list(bot.config.nickname)[0], msg))
+        await send_forward_menu(bot, event, pages)
     else:
-        await matcher.finish(msg)
+        await matcher.finish(pages[0])
+
+
+@search_food.handle()
+async def _(event: MessageEvent, args: Message = CommandArg()):
+    keyword: str = args.extract_plain_text().strip()
+    if not keyword:
+        await search_food.finish("还没输入关键词呢，例如[搜索 鸡]")
+
+    await search_food.finish(await eating_manager.search_food(event, keyword))
 
 
 @greeting_on.handle()
 async def _(event: GroupMessageEvent):
     gid = str(event.group_id)
-    eating_manager.update_greeting_status(gid, True)
+    await eating_manager.update_greeting_status(gid, True)
     await greeting_on.finish("已开启吃饭小助手~")
 
 
 @greeting_off.handle()
 async def _(event: GroupMessageEvent):
     gid = str(event.group_id)
-    eating_manager.update_greeting_status(gid, False)
+    await eating_manager.update_greeting_status(gid, False)
     await greeting_off.finish("已关闭吃饭小助手~")
 
 
@@ -249,7 +414,7 @@ async def handle_skip():
 async def handle_add_greeting(state: T_State, greeting: Message = Arg()):
     meal = state["meal"]
     # Not support for text + image greeting, just extract the plain text
-    msg = eating_manager.add_greeting(meal, greeting.extract_plain_text())
+    msg = await eating_manager.add_greeting(meal, greeting.extract_plain_text())
     await add_greeting.finish(msg)
 
 
@@ -270,16 +435,151 @@ async def handle_show_greetings(meal: Meals = Arg()):
 )
 async def handle_remove_greeting(state: T_State, index: int = Arg()):
     meal = state["meal"]
-    msg = eating_manager.remove_greeting(meal, index)
+    msg = await eating_manager.remove_greeting(meal, index)
     await remove_greeting.finish(msg)
 
 
+@show_metrics.handle()
+async def _():
+    await show_metrics.finish(registry.render().strip())
+
+
+@export_data.handle()
+async def _():
+    export_dir: Path = what2eat_config.what2eat_path / "export"
+    n_basic, n_groups = await eating_manager.export(export_dir)
+    await export_data.finish(f"已导出基础菜单{n_basic}道、{n_groups}个群的特色菜单至 {export_dir} 🤤")
+
+
+@sweep_images.handle()
+async def _():
+    report = await eating_manager.sweep_images()
+    await sweep_images.finish(str(report))
+
+
+# ------------------------- Metrics -------------------------
+_timed_matchers: Dict[Type[Matcher], str] = {
+    what2eat: "what2eat",
+    what2drink: "what2drink",
+    show_group_menu: "show_group_menu",
+    show_basic_menu: "show_basic_menu",
+    search_food: "search_food",
+    greeting_on: "greeting_on",
+    greeting_off: "greeting_off",
+    add_greeting: "add_greeting",
+    remove_greeting: "remove_greeting"
+}
+
+
+@run_preprocessor
+async def _(matcher: Matcher):
+    if type(matcher) in _timed_matchers:
+        matcher.state["_what2eat_start"] = time.perf_counter()
+
+
+@run_postprocessor
+async def _(matcher: Matcher):
+    start = matcher.state.pop("_what2eat_start", None)
+    if start is not None:
+        handler_seconds.observe(time.perf_counter() - start,
+                                handler=_timed_matchers[type(matcher)])
+
+
+# ------------------------- Data -------------------------
+driver = get_driver()
+exporter = Exporter(what2eat_config.what2eat_metrics_host,
+                    what2eat_config.what2eat_metrics_port)
+update_task: Optional[asyncio.Task] = None
+
+
+async def update_resources() -> None:
+    '''
+        Update eating.json and drinks.json from repo, running in background once data is loaded.
+        deltas.json is fetched first: if not modified, both are up to date; otherwise each resource
+        applies its chain of deltas, or falls back to a full merge.
+    '''
+    try:
+        manifest: Optional[Dict[str, Any]] = await fetch_resource("deltas.json", conditional=True)
+    except DownloadError as e:
+        logger.warning(f"{e}, fall back to full merge")
+        manifest = {}
+
+    if manifest is None:
+        return
+
+    results: List[Any] = await asyncio.gather(
+        eating_manager.update_basic_food(manifest.get("eating.json")),
+        drinks_update(manifest.get("drinks.json")),
+        return_exceptions=True
+    )
+
+    failed: bool = False
+    for res in results:
+        if isinstance(res, Exception):
+            logger.warning(f"Failed to update what2eat resources: {res}")
+            failed = True
+        else:
+            logger.info(str(res))
+
+    if manifest and not failed:
+        await commit_resource("deltas.json")
+
+
+@driver.on_startup
+async def _():
+    global update_task
+
+    # Registered after what2eat_check, so the resources are ready
+    await eating_manager.load()
+    await exporter.start()
+
+    if what2eat_config.what2eat_auto_update:
+        update_task = asyncio.create_task(update_resources())
+
+
+@driver.on_shutdown
+async def _():
+    if update_task is not None and not update_task.done():
+        update_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await update_task
+
+    # The update task downloads through it till cancelled
+    await downloader.shutdown()
+    await exporter.stop()
+    await eating_manager.close()
+
+
 # ------------------------- Schedulers -------------------------
-# 重置吃什么次数，包括夜宵
-@scheduler.scheduled_job("cron", hour="6,11,17,22", minute=0, misfire_grace_time=60)
+# 定时写回内存中的数据
+@scheduler.scheduled_job("interval", seconds=what2eat_config.what2eat_flush_interval, misfire_grace_time=60)
 async def _():
-    eating_manager.reset_count()
-    logger.info("今天吃什么次数已刷新")
+    await eating_manager.flush()
+
+
+async def watch_data() -> None:
+    '''
+        Swap in the data once changed by other processes sharing what2eat_path, or edited by hand
+    '''
+    await eating_manager.sync()
+
+
+if what2eat_config.what2eat_watch_interval > 0:
+    scheduler.add_job(watch_data, "interval", seconds=what2eat_config.what2eat_watch_interval,
+                      max_instances=1, coalesce=True)
+
+
+async def sweep_orphan_images() -> None:
+    '''
+        Delete images no food refers to, which removals, failed deletions and hand edits leave behind
+    '''
+    report = await eating_manager.sweep_images()
+    logger.info(f"清理图片：{report}")
+
+
+if what2eat_config.what2eat_image_sweep_hours > 0:
+    scheduler.add_job(sweep_orphan_images, "interval", hours=what2eat_config.what2eat_image_sweep_hours,
+                      max_instances=1, coalesce=True)
 
 
 # 早餐提醒
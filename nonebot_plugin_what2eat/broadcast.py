@@ -0,0 +1,110 @@
+import asyncio
+import random
+import time
+from typing import FrozenSet, Iterable, List, NamedTuple, Union
+
+from nonebot import Bot, logger
+from nonebot.adapters.onebot.v11 import (ActionFailed, Message, MessageSegment,
+                                         NetworkError)
+
+from .metrics import broadcast_groups, broadcast_retries, broadcast_seconds
+
+# OneBot v11 retcode 201: the worker pool of the implementation is not ready. Others such as 100 and 103
+# (missing group, muted, removed from the group) fail again however many times they are retried
+RETRYABLE_RETCODES: FrozenSet[int] = frozenset({201})
+
+
+class BroadcastReport(NamedTuple):
+    total: int
+    succeeded: int
+    failed: int
+    retried: int
+    elapsed: float          # Seconds until the last group is done
+
+    def __str__(self) -> str:
+        return f"共{self.total}个群，成功{self.succeeded}，失败{self.failed}，重试{self.retried}次，耗时{self.elapsed:.2f}s"
+
+
+class TokenBucket:
+    '''
+        Allow rate requests per second on average and bursts up to capacity
+    '''
+
+    def __init__(self, rate: float, capacity: int):
+        self._rate: float = rate
+        self._capacity: float = float(capacity)
+        self._tokens: float = float(capacity)
+        self._updated: float = time.monotonic()
+        self._lock: asyncio.Lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now: float = time.monotonic()
+                self._tokens = min(
+                    self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class Broadcaster:
+    '''
+        Send a message to many groups concurrently, at most concurrency sends in flight and
+        at most rate_limit sends per second. NetworkError and ActionFailed with a retcode in
+        RETRYABLE_RETCODES are retried with backoff, other failures are logged and skipped.
+    '''
+
+    def __init__(self, concurrency: int = 8, rate_limit: float = 5.0, retries: int = 2):
+        self._concurrency: int = max(1, concurrency)
+        self._rate_limit: float = rate_limit
+        self._retries: int = retries
+
+    async def broadcast(self, bot: Bot, groups_id: Iterable[str], msg: Union[Message, MessageSegment]) -> BroadcastReport:
+        gids: List[str] = list(groups_id)
+        semaphore = asyncio.Semaphore(self._concurrency)
+        bucket = TokenBucket(
+            self._rate_limit, self._concurrency) if self._rate_limit > 0 else None
+        retried: int = 0
+        start: float = time.monotonic()
+
+        async def _send(gid: str) -> bool:
+            nonlocal retried
+
+            async with semaphore:
+                for i in range(self._retries + 1):
+                    if bucket is not None:
+                        await bucket.acquire()
+
+                    try:
+                        await bot.call_api("send_group_msg", group_id=int(gid), message=msg)
+                        return True
+                    except (ActionFailed, NetworkError) as e:
+                        if isinstance(e, ActionFailed) and e.info.get("retcode") not in RETRYABLE_RETCODES:
+                            logger.warning(f"发送群 {gid} 失败，不再重试：{e}")
+                            return False
+
+                        if i == self._retries:
+                            logger.warning(f"发送群 {gid} 失败：{e}")
+                            return False
+
+                        retried += 1
+                        await asyncio.sleep(random.uniform(0, 0.5 * 2 ** i))
+
+            return False
+
+        results: List[bool] = await asyncio.gather(*[_send(gid) for gid in gids])
+        succeeded: int = sum(results)
+        report = BroadcastReport(len(gids), succeeded, len(gids) - succeeded,
+                                 retried, time.monotonic() - start)
+
+        broadcast_seconds.observe(report.elapsed)
+        broadcast_groups.inc(report.succeeded, result="succeeded")
+        broadcast_groups.inc(report.failed, result="failed")
+        broadcast_retries.inc(report.retried)
+
+        return report
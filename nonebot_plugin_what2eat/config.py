@@ -1,16 +1,15 @@
+import asyncio
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set, Union
+from typing import Any, Dict, List, Literal, Optional, Set, Union
 
-import httpx
 from nonebot import get_driver, logger
 from pydantic import BaseModel, Extra
 
-from .utils import Meals, save_json
-
-try:
-    import ujson as json
-except ModuleNotFoundError:
-    import json
+from .delta import MergeReport, apply_dict_delta, find_chain
+from .locking import FileLock
+from .network import Downloader, Validators
+from .serializer import configure, find_data
+from .utils import Meals, load_data, load_json, run_sync, save_data, save_json
 
 
 class PluginConfig(BaseModel, extra=Extra.ignore):
@@ -18,12 +17,56 @@ class PluginConfig(BaseModel, extra=Extra.ignore):
     use_preset_menu: bool = False
     use_preset_greetings: bool = False
     eating_limit: int = 5
+    eating_reset_hours: List[int] = [6, 11, 17, 22]
     greeting_groups_id: Set[str] = set()
+    greeting_concurrency: int = 8
+    greeting_rate_limit: float = 5.0
+    greeting_retries: int = 2
     what2eat_auto_update: bool = False
+    what2eat_startup_timeout: float = 30.0
+    what2eat_flush_interval: int = 60
+    what2eat_watch_interval: int = 5
+    what2eat_menu_page_size: int = 50
+    what2eat_storage: Literal["json", "sqlite", "shard"] = "json"
+    what2eat_shard_cache_size: int = 256
+    what2eat_journal: bool = True
+    what2eat_serializer: Literal["json", "orjson", "msgpack"] = "json"
+    what2eat_compact: bool = False
+    what2eat_drink_sampling: Literal["brand", "drink", "custom"] = "brand"
+    what2eat_drink_weights: Dict[str, float] = {}
+    what2eat_no_repeat: Literal["off", "group", "user"] = "off"
+    what2eat_image_max_size: int = 1280
+    what2eat_image_quality: int = 80
+    what2eat_image_workers: int = 2
+    what2eat_image_quota_mb: int = 0
+    what2eat_image_grace_hours: float = 24
+    what2eat_image_sweep_hours: float = 24
+    what2eat_resource_url: str = "https://raw.fgit.ml/MinatoAquaCrews/nonebot_plugin_what2eat/master/nonebot_plugin_what2eat/resource/"
+    what2eat_http_timeout: float = 10.0
+    what2eat_http_retries: int = 3
+    what2eat_http_backoff: float = 0.5
+    what2eat_http_concurrency: int = 8
+    what2eat_metrics_host: str = "127.0.0.1"
+    what2eat_metrics_port: Optional[int] = None
 
 
 driver = get_driver()
 what2eat_config: PluginConfig = PluginConfig.parse_obj(driver.config.dict())
+configure(what2eat_config.what2eat_serializer,
+          what2eat_config.what2eat_compact)
+
+downloader = Downloader(
+    timeout=what2eat_config.what2eat_http_timeout,
+    retries=what2eat_config.what2eat_http_retries,
+    backoff=what2eat_config.what2eat_http_backoff,
+    concurrency=what2eat_config.what2eat_http_concurrency
+)
+# Registered before what2eat_check, which downloads through it. Shut down by the plugin, after the update task
+driver.on_startup(downloader.startup)
+validators = Validators(what2eat_config.what2eat_path /
+                        "what2eat.validators.json")
+# Taken by read-modify-write cycles on files under what2eat_path, which processes may share
+file_lock = FileLock(what2eat_config.what2eat_path / "what2eat.lock")
 
 
 class ResourceError(Exception):
@@ -38,205 +81,207 @@ class DownloadError(Exception):
     pass
 
 
-async def download_url(name: str) -> Optional[Dict[str, Any]]:
-    url: str = "https://raw.fgit.ml/MinatoAquaCrews/nonebot_plugin_what2eat/master/nonebot_plugin_what2eat/resource/" + name
-
-    async with httpx.AsyncClient() as client:
-        for i in range(3):
-            try:
-                response = await client.get(url)
-                if response.status_code != 200:
-                    continue
+def resource_url(name: str) -> str:
+    return what2eat_config.what2eat_resource_url.rstrip("/") + "/" + name
 
-                return response.json()
 
-            except Exception:
-                logger.warning(
-                    f"Error occured when downloading {url}, retry: {i+1}/3")
-
-    logger.warning("Abort downloading")
-    return None
+async def download_url(name: str) -> Optional[Dict[str, Any]]:
+    return await downloader.get_json(resource_url(name))
 
 
-async def eating_check() -> None:
+async def fetch_resource(name: str, conditional: bool = False) -> Optional[Dict[str, Any]]:
     '''
-        Get the latest eating.json from repo.
-        If it's newer than local, get the union set of "basic_food".
+        Download a text resource from repo, which must have the key "version".
+        If conditional, validators of the last applied download are sent and None is returned
+        when it's not modified. Call commit_resource once the resource is applied.
     '''
-    eating_json: Path = what2eat_config.what2eat_path / "eating.json"
-    cur_version: float = 0
+    url: str = resource_url(name)
+    headers: Dict[str, str] = await run_sync(validators.headers, url) if conditional else {}
+    response = await downloader.get(url, headers)
+    if response is None:
+        raise DownloadError(f"Failed to download {name}")
 
-    if what2eat_config.what2eat_auto_update:
-        response = await download_url("eating.json")
-    else:
-        response = None
+    if response.status_code == 304:
+        logger.info(f"{name} is not modified since the last update")
+        return None
 
-    if response is None:
-        if not eating_json.exists():
-            logger.warning("What2eat text resource missing! Please check!")
-            raise ResourceError("Missing necessary resource: eating.json!")
+    try:
+        _remote: Dict[str, Any] = response.json()
+    except ValueError:
+        raise DownloadError(f"Invalid JSON of {name}")
+
+    if "version" not in _remote:
+        logger.warning(
+            "What2eat text resource downloaded incompletely! Please check!")
+        raise DownloadError(f"{name} downloaded incompletely")
+
+    validators.stage(url, response)
 
-    else:
-        # Get the latest eating.json from repo and local data exists, check the keys then merge
-        try:
-            version: float = response["version"]
-        except KeyError:
-            logger.warning(
-                "What2eat text resource downloaded incompletely! Please check!")
-            raise DownloadError
+    return _remote
 
-        # Get the latest eating.json from repo but local data doesn't exist, save
-        if not eating_json.exists():
-            save_json(eating_json, response)
 
-        # Merge "basic_food"
-        else:
-            with eating_json.open("r", encoding="utf-8") as f:
-                _local = json.load(f)
+async def commit_resource(name: str) -> None:
+    await run_sync(validators.commit, resource_url(name))
 
-                # For version below 0.3.6, there's no key of "version", set default 0
-                cur_version = _local.get("version", 0)
 
-                if not _local.get("basic_food", False):
-                    _local.update({"basic_food": []})
+async def download_resource(name: str) -> Dict[str, Any]:
+    '''
+        Download a text resource from repo and save it, for it's missing locally
+    '''
+    _remote: Dict[str, Any] = await fetch_resource(name)
+    await run_sync(save_json, what2eat_config.what2eat_path / name, _remote)
+    await commit_resource(name)
+    logger.info(f"Downloaded {name} from repo")
+
+    return _remote
 
-                if not _local.get("group_food", False):
-                    _local.update({"group_food": {}})
 
-                if not _local.get("count", False):
-                    _local.update({"count": {}})
+async def eating_check() -> None:
+    '''
+        Check eating.json and its keys, the file is only written when keys are missing.
+        If it doesn't exist in any format, try to download when auto update is on.
+    '''
+    eating_json: Path = what2eat_config.what2eat_path / "eating.json"
 
-                # Merge "basic_food" when there is a newer version
-                if version > cur_version:
-                    _local.update({"version": version})
+    if find_data(eating_json) is None:
+        if not what2eat_config.what2eat_auto_update:
+            logger.warning("What2eat text resource missing! Please check!")
+            raise ResourceError("Missing necessary resource: eating.json!")
 
-                    local_basic_food: List[str] = _local.get("basic_food", [])
-                    newer_basic_food: List[str] = response.get(
-                        "basic_food", [])
-                    merged_basic_food: List[str] = list(
-                        set(local_basic_food).union(set(newer_basic_food)))
+        await download_resource("eating.json")
+        return
 
-                    _local.update({"basic_food": merged_basic_food})
+    async with file_lock:
+        _local: Dict[str, Any] = await run_sync(load_data, eating_json)
+        changed: bool = False
 
-            save_json(eating_json, _local)
+        # For version below 0.3.6, there's no key of "version", set default 0
+        for key, default in (("version", 0), ("basic_food", []), ("group_food", {}), ("count", {})):
+            if key not in _local:
+                _local[key] = default
+                changed = True
 
-        if version > cur_version:
-            logger.info(
-                f"Updated eating.json, version: {cur_version} -> {version}")
+        if changed:
+            await run_sync(save_data, eating_json, _local)
 
 
 async def drinks_check() -> None:
     '''
-        Get the latest drinks.json from repo.
-        If it's newer than local, get the union set of each keys in drinks.json
+        Check drinks.json exists. If not, try to download when auto update is on.
     '''
     drinks_json: Path = what2eat_config.what2eat_path / "drinks.json"
-    cur_version: float = 0
-
-    if what2eat_config.what2eat_auto_update:
-        response = await download_url("drinks.json")
-    else:
-        response = None
 
-    if response is None:
-        if not drinks_json.exists():
+    if not drinks_json.exists():
+        if not what2eat_config.what2eat_auto_update:
             logger.warning("What2eat text resource missing! Please check!")
             raise ResourceError("Missing necessary resource: drinks.json!")
 
-    else:
-        try:
-            version: float = response["version"]
-        except KeyError:
-            logger.warning(
-                "What2eat text resource downloaded incompletely! Please check!")
-            raise DownloadError
-
-        # Update when there is a newer version
-        if version > cur_version:
-            if not drinks_json.exists():
-                save_json(drinks_json, response)
-            else:
-                with drinks_json.open("r", encoding="utf-8") as f:
-                    _local: Dict[str, Union[float, List[str]]] = json.load(f)
-
-                    # Merge keys
-                    local_branches: List[str] = _local.keys()
-                    newer_branches: List[str] = response.keys()
-                    merged_branches: List[str] = list(
-                        set(local_branches).union(set(newer_branches)))
-
-                    # Merge each of drink branches
-                    for branch in merged_branches:
-                        if branch == "version":
-                            _local.update({branch: response[branch]})
-                            continue
-
-                        if branch in _local:
-                            # Branch in local and in repo, merge drinking list
-                            if branch in response:
-                                local_drinks: List[str] = _local.get(
-                                    branch, [])
-                                newer_drinks: List[str] = response.get(
-                                    branch, [])
-                                merged_drinks: List[str] = list(
-                                    set(local_drinks).union(set(newer_drinks)))
-
-                                _local.update({branch: merged_drinks})
-                        else:
-                            # Branch but in local, update it
-                            _local.update({branch: response[branch]})
-
-                save_json(drinks_json, _local)
-
-            logger.info(
-                f"Updated drinks.json, version: {cur_version} -> {version}")
+        await download_resource("drinks.json")
 
 
 async def greetings_check() -> None:
     '''
-        Check greetings.json and its keys
-        If doesn't exist, try to download. Otherwise, check its keys.
-        greetings.json will NOT auto check for update.
+        Check greetings.json and its keys, the file is only written when keys are missing.
+        If it doesn't exist, try to download. greetings.json will NOT auto check for update.
+        Groups in greeting_groups_id are turned on by EatingManager once loaded.
     '''
     greetings_json: Path = what2eat_config.what2eat_path / "greetings.json"
 
-    if not greetings_json.exists():
+    if find_data(greetings_json) is None:
         response = await download_url("greetings.json")
 
         if response is None:
             logger.warning("What2eat text resource missing! Please check!")
             raise ResourceError("Missing necessary resource: greetings.json!")
-        else:
-            save_json(greetings_json, response)
-            logger.info(f"Downloaded greetings.json from repo")
-    else:
-        # Exists then check the keys
-        with greetings_json.open("r", encoding="utf-8") as f:
-            _local: Dict[str, Union[List[str], Dict[str, bool]]] = json.load(f)
 
-            for meal in Meals:
-                if not _local.get(meal.value[0], False):
-                    _local.update({meal.value[0]: []})
+        await run_sync(save_json, greetings_json, response)
+        logger.info(f"Downloaded greetings.json from repo")
+        return
+
+    async with file_lock:
+        _local: Dict[str, Union[List[str], Dict[str, bool]]] = await run_sync(load_data, greetings_json)
+        changed: bool = False
+
+        for key in [meal.value[0] for meal in Meals] + ["groups_id"]:
+            if key not in _local:
+                _local[key] = {} if key == "groups_id" else []
+                changed = True
+
+        if changed:
+            await run_sync(save_data, greetings_json, _local)
+
+
+async def drinks_update(entry: Optional[Dict[str, Any]]) -> MergeReport:
+    '''
+        Update drinks.json from repo. Apply the chain of deltas in entry of deltas.json if any,
+        otherwise get the latest drinks.json and if it's newer than local, merge each brand.
+        The merge re-reads drinks.json under file_lock, and gives up if another process has
+        updated it meanwhile. DrinkCatalog reloads it as its mtime changes.
+    '''
+    drinks_json: Path = what2eat_config.what2eat_path / "drinks.json"
+    _local: Dict[str, Union[float, List[str]]] = await run_sync(load_json, drinks_json)
+    cur_version: float = _local.get("version", 0)
+    chain: Optional[List[Dict[str, Any]]] = find_chain(entry, cur_version)
+
+    if chain == []:
+        return MergeReport("drinks.json", "none", cur_version, cur_version, 0, 0)
+
+    mode: str = "delta"
+    if chain is None:
+        response = await fetch_resource("drinks.json", conditional=True)
+        if response is None or response["version"] <= cur_version:
+            if response is not None:
+                await commit_resource("drinks.json")
+
+            return MergeReport("drinks.json", "none", cur_version, cur_version, 0, 0)
 
-            if not _local.get("groups_id", False):
-                _local.update({"groups_id": {}})
+        # Branches in local and in repo are merged, branches not in local are added
+        mode = "full"
+        chain = [{"version": response["version"],
+                  "added": {branch: drinks for branch, drinks in response.items() if branch != "version"}}]
 
-            # Always update "groups_id" if greeting_groups_id is not empty
-            if len(what2eat_config.greeting_groups_id) > 0:
-                for gid in what2eat_config.greeting_groups_id:
-                    _local["groups_id"].update({gid: True})
+    async with file_lock:
+        _local = await run_sync(load_json, drinks_json)
+        if _local.get("version", 0) != cur_version:
+            return MergeReport("drinks.json", "none", cur_version, _local.get("version", 0), 0, 0)
 
-        save_json(greetings_json, _local)
+        added: int = 0
+        removed: int = 0
+        for delta in chain:
+            _local, n_added, n_removed = apply_dict_delta(
+                _local, delta.get("added", {}), delta.get("removed", {}))
+            _local["version"] = delta["version"]
+            added += n_added
+            removed += n_removed
+
+        await run_sync(save_json, drinks_json, _local)
+
+    if mode == "full":
+        await commit_resource("drinks.json")
+
+    return MergeReport("drinks.json", mode, cur_version, _local["version"], added, removed)
 
 
 @driver.on_startup
 async def what2eat_check() -> None:
+    '''
+        Check local resources concurrently under what2eat_startup_timeout.
+        Only missing resources are downloaded here, updates are merged in background once loaded.
+    '''
     if not what2eat_config.what2eat_path.exists():
         what2eat_config.what2eat_path.mkdir(parents=True, exist_ok=True)
 
     if not (what2eat_config.what2eat_path / "img").exists():
         (what2eat_config.what2eat_path / "img").mkdir(parents=True, exist_ok=True)
 
-    await eating_check()
-    await drinks_check()
-    await greetings_check()
+    try:
+        await asyncio.wait_for(asyncio.gather(eating_check(), drinks_check(), greetings_check()),
+                               what2eat_config.what2eat_startup_timeout)
+    except asyncio.TimeoutError:
+        for name in ("eating.json", "drinks.json", "greetings.json"):
+            if find_data(what2eat_config.what2eat_path / name) is None:
+                raise ResourceError(
+                    f"Missing necessary resource: {name}! Timed out checking resources")
+
+        logger.warning(
+            f"Checking what2eat resources timed out after {what2eat_config.what2eat_startup_timeout}s")
@@ -1,13 +1,27 @@
+import asyncio
+import os
 import random
+import time
+from collections import OrderedDict
+from contextlib import suppress
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
+import aiofiles
 from nonebot import Bot, get_bot, get_driver, logger
-from nonebot.adapters.onebot.v11 import (ActionFailed, GroupMessageEvent,
-                                         Message, MessageSegment,
-                                         PrivateMessageEvent)
-
-from .config import what2eat_config
+from nonebot.adapters.onebot.v11 import (GroupMessageEvent, Message,
+                                         MessageSegment, PrivateMessageEvent)
+
+from .broadcast import Broadcaster, BroadcastReport
+from .config import commit_resource, fetch_resource, file_lock, what2eat_config
+from .delta import MergeReport, find_chain
+from .drinks import DrinkCatalog
+from .images import ImageStore, SweepReport
+from .menu import (IMPORT_LIMIT, SEARCH_LIMIT, CandidatePool, FoodIndex,
+                   GroupPool, Pool, image_key, paginate_menu)
+from .sampler import ShuffleBags
+from .serializer import JsonSerializer
+from .storage import JsonStorage, ShardStorage, SqliteStorage, Storage
 from .utils import *
 
 
@@ -22,66 +36,483 @@ class EatingManager:
         self._drinks_json: Path = what2eat_config.what2eat_path / "drinks.json"
         self._img_dir: Path = what2eat_config.what2eat_path / "img"
 
-    def _init_data(self, gid: str, uid: Optional[str] = None) -> None:
+        self._storage: Optional[Storage] = None
+        # The meal window now is in, counters of other epochs read as zero
+        self._window: Tuple[int, int] = (0, 0)
+        self._images: ImageStore = ImageStore(self._img_dir, what2eat_config.what2eat_image_max_size,
+                                              what2eat_config.what2eat_image_quality, what2eat_config.what2eat_image_workers,
+                                              what2eat_config.what2eat_image_quota_mb << 20)
+        # Compressing images stored before compression was on
+        self._compact_task: Optional[asyncio.Task] = None
+        self._broadcaster: Broadcaster = Broadcaster(
+            what2eat_config.greeting_concurrency, what2eat_config.greeting_rate_limit, what2eat_config.greeting_retries)
+        self._drinks: DrinkCatalog = DrinkCatalog(
+            self._drinks_json, what2eat_config.what2eat_drink_sampling, what2eat_config.what2eat_drink_weights)
+        # Candidate pools of basic_food ∪ group_food, built on first pick of each group, and of basic_food (key None)
+        self._pools: Dict[Optional[str], Pool] = {}
+        # No-repeat sampling state by group or user, if what2eat_no_repeat is on
+        self._bags: ShuffleBags = ShuffleBags()
+        # Hash indexes of the basic menu (key None) and each group's menu, built on first lookup
+        self._indexes: Dict[Optional[str], FoodIndex] = {}
+        # Version of the basic menu (key None) and each group's menu, bumped on every change
+        self._menu_versions: Dict[Optional[str], int] = {}
+        # Rendered menus with the version they were rendered at
+        self._rendered: Dict[Optional[str],
+                             Tuple[int, Tuple[bool, List[Message]]]] = {}
+        # Groups in memory from least to most recently used, if the storage loads groups lazily
+        self._resident: "OrderedDict[str, None]" = OrderedDict()
+        # Times each group was evicted, a load across an eviction may read the shard before it's written
+        self._evictions: Dict[str, int] = {}
+        # Groups being made resident by _ensure_group, never evicted meanwhile
+        self._pinned: Dict[str, int] = {}
+
+    async def load(self) -> None:
+        '''
+            Load the data into memory from the storage backend, called once resources are checked
+        '''
+        if what2eat_config.what2eat_storage == "sqlite":
+            self._storage = SqliteStorage(
+                what2eat_config.what2eat_path / "what2eat.db", self._eating_json, self._greetings_json, file_lock)
+        elif what2eat_config.what2eat_storage == "shard":
+            self._storage = ShardStorage(
+                what2eat_config.what2eat_path / "shards", self._eating_json, self._greetings_json, file_lock)
+        else:
+            self._storage = JsonStorage(self._eating_json, self._greetings_json, file_lock,
+                                        what2eat_config.what2eat_path / "what2eat.journal" if what2eat_config.what2eat_journal else None)
+
+        self._storage.on_reload = self._reload
+        self._eating, self._greetings = await self._storage.load()
+        self._pools.clear()
+        self._indexes.clear()
+        self._rendered.clear()
+        self._resident.clear()
+
+        await run_sync(self._images.load)
+        self._bags.bind(self._eating.setdefault("bags", {}))
+        await self._import_bags(what2eat_config.what2eat_path / "what2eat.bags.json")
+
+        await self._migrate_images([(None, self._eating["basic_food"])] + list(self._eating["group_food"].items()))
+        self._compact_task = asyncio.create_task(self._compact_images())
+
+        # Groups in greeting_groups_id are always turned on
+        for gid in what2eat_config.greeting_groups_id:
+            if not self._greetings["groups_id"].get(gid, False):
+                await self.update_greeting_status(gid, True)
+
+    async def _migrate_images(self, menus: List[Tuple[Optional[str], List[str]]]) -> None:
+        '''
+            Move images saved under client filenames to their content addresses, updating the foods
+        '''
+        migrated: bool = False
+
+        for gid, foods in menus:
+            for i, food in enumerate(foods):
+                new_food: str = await run_sync(self._images.migrate, food)
+                if new_food != food:
+                    foods[i] = new_food
+                    self._bump_version(gid)
+                    await self._storage.remove_food(gid, food)
+                    await self._storage.add_food(gid, new_food)
+                    migrated = True
+
+        if migrated:
+            await self._storage.flush()
+
+    async def _compact_images(self) -> None:
+        if await self._images.compact_all() > 0:
+            # Menus rendered meanwhile still refer to the originals
+            self._rendered.clear()
+            await run_sync(self._images.save_sizes)
+
+    async def _import_bags(self, bags_json: Path) -> None:
+        '''
+            Shuffle bags were kept in what2eat.bags.json by versions before, move them to the storage
+        '''
+        if not bags_json.exists():
+            return
+
+        await run_sync(self._bags.import_file, bags_json)
+        await self._save_bags()
+        await self._storage.flush()
+        bags_json.unlink()
+        logger.info(f"Moved shuffle bags of {bags_json.name} to the storage")
+
+    async def _save_bags(self) -> None:
+        foods, drinks = self._bags.changes()
+        if foods or drinks:
+            await self._storage.save_bags(foods, drinks)
+
+    def _reload(self, _eating: Dict, _greetings: Dict) -> None:
+        '''
+            Swap in the data changed by another process, dropping everything derived from the old one
+        '''
+        self._eating, self._greetings = _eating, _greetings
+        self._bags.bind(_eating.setdefault("bags", {}))
+        self._pools.clear()
+        self._indexes.clear()
+        self._rendered.clear()
+
+    async def sync(self) -> None:
+        '''
+            Reload the data if changed by another process or edited by hand
+        '''
+        if self._storage is not None:
+            await self._storage.sync()
+
+    async def flush(self) -> None:
+        '''
+            Write the in-memory data back if the storage backend defers writing
+        '''
+        if self._storage is not None:
+            await self._save_bags()
+            await self._storage.flush()
+
+        await run_sync(self._images.save_sizes)
+
+    async def close(self) -> None:
+        if self._compact_task is not None and not self._compact_task.done():
+            self._compact_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._compact_task
+
+        await run_sync(self._images.save_sizes)
+        await run_sync(self._images.close)
+        if self._storage is not None:
+            await self._save_bags()
+            await self._storage.close()
+            self._storage = None
+
+    async def _ensure_group(self, gid: str) -> None:
+        '''
+            Make the group resident in memory if the storage loads groups lazily,
+            evicting the least recently used groups beyond what2eat_shard_cache_size.
+            Once returned, the group stays resident until the caller awaits.
+            Once loaded, the group is pinned until returned, so that concurrent loads of other groups
+            can't evict it over and over; groups may exceed the cache while all of them are pinned.
+        '''
+        if not self._storage.lazy:
+            return
+
+        # Events of other groups may evict it whenever awaiting, so check again each time
+        while gid not in self._resident:
+            evictions: int = self._evictions.get(gid, 0)
+            foods, counts = await self._storage.load_group(gid)
+            if gid in self._resident:
+                break
+
+            if evictions != self._evictions.get(gid, 0):
+                continue
+
+            self._eating["group_food"][gid] = foods
+            self._eating["count"][gid] = counts
+            self._resident[gid] = None
+
+            self._pinned[gid] = self._pinned.get(gid, 0) + 1
+            try:
+                await self._migrate_images([(gid, foods)])
+                # Images removed with foods of other groups while the group was not in memory
+                for food in [food for food in foods if self._images.is_missing(food)]:
+                    if food in self._eating["group_food"].get(gid, []):
+                        await self._remove_food(gid, food)
+
+                while len(self._resident) > max(1, what2eat_config.what2eat_shard_cache_size):
+                    victim: Optional[str] = next(
+                        (g for g in self._resident if g not in self._pinned), None)
+                    if victim is None:
+                        break
+
+                    await self._evict(victim)
+            finally:
+                self._pinned[gid] -= 1
+                if self._pinned[gid] == 0:
+                    self._pinned.pop(gid)
+
+        self._resident.move_to_end(gid)
+
+    async def _evict(self, gid: str) -> None:
+        self._resident.pop(gid)
+        self._evictions[gid] = self._evictions.get(gid, 0) + 1
+        foods: List[str] = self._eating["group_food"].pop(gid, [])
+        counts: Dict[str, List[int]] = self._eating["count"].pop(gid, {})
+        self._pools.pop(gid, None)
+        self._indexes.pop(gid, None)
+        self._rendered.pop(gid, None)
+
+        await self._storage.unload_group(gid, foods, counts)
+
+    async def _read_group(self, gid: str) -> Tuple[List[str], Dict[str, List[int]]]:
+        '''
+            The menu and counts of a group, read from the storage without making it resident
+        '''
+        while gid not in self._resident:
+            evictions: int = self._evictions.get(gid, 0)
+            foods, counts = await self._storage.load_group(gid)
+            if gid not in self._resident and evictions == self._evictions.get(gid, 0):
+                return foods, counts
+
+        return self._eating["group_food"].get(gid, []), self._eating["count"].get(gid, {})
+
+    async def export(self, export_dir: Path) -> Tuple[int, int]:
         '''
-            初始化用户信息
+            Export all the data as indented eating.json and greetings.json under export_dir,
+            whatever the storage and serializer are. Return numbers of basic foods and groups.
+            The files are in the original format, so they can be put back as resources.
+        '''
+        _eating: Dict[str, Any] = {
+            "version": self._eating["version"],
+            "basic_food": list(self._eating["basic_food"]),
+            "group_food": {},
+            "count": {}
+        }
+
+        gids: List[str] = list(self._eating["group_food"])
+        if self._storage.lazy:
+            gids = sorted(set(gids) | set(await self._storage.list_groups()))
+
+        for gid in gids:
+            if self._storage.lazy:
+                foods, counts = await self._read_group(gid)
+            else:
+                foods = self._eating["group_food"][gid]
+                counts = self._eating["count"].get(gid, {})
+
+            _eating["group_food"][gid] = list(foods)
+            _eating["count"][gid] = dict(counts)
+
+        # Counts of groups without any food
+        for gid, counts in self._eating["count"].items():
+            _eating["count"].setdefault(gid, dict(counts))
+
+        pretty: JsonSerializer = JsonSerializer()
+        export_dir.mkdir(parents=True, exist_ok=True)
+        await run_sync(write_file, export_dir / "eating.json", pretty.dumps(_eating))
+        await run_sync(write_file, export_dir / "greetings.json", pretty.dumps(self._greetings))
+
+        return len(_eating["basic_food"]), len(_eating["group_food"])
+
+    def _init_data(self, gid: str) -> None:
+        '''
+            初始化群组信息，用户次数见 _get_count
         '''
         if gid not in self._eating["group_food"]:
             self._eating["group_food"][gid] = []
         if gid not in self._eating["count"]:
             self._eating["count"][gid] = {}
 
-        if isinstance(uid, str):
-            if uid not in self._eating["count"][gid]:
-                self._eating["count"][gid][uid] = 0
+    def _current_epoch(self) -> int:
+        if time.time() >= self._window[1]:
+            self._window = get_meal_window(what2eat_config.eating_reset_hours)
+
+        return self._window[0]
+
+    def _get_count(self, gid: str, uid: str) -> int:
+        '''
+            Count of the user in current meal window. Counters are [count, epoch], stale if epoch differs
+        '''
+        count: Union[int, List[int],
+                     None] = self._eating["count"][gid].get(uid)
+        if isinstance(count, list) and count[1] == self._current_epoch():
+            return count[0]
+
+        return 0
+
+    async def _incr_count(self, gid: str, uid: str) -> None:
+        '''
+            Memory is updated before the first await, so concurrent events never lose an increment.
+            The storage keeps it as an increment too, not lost to other processes sharing the data.
+        '''
+        epoch: int = self._current_epoch()
+        self._eating["count"][gid][uid] = [
+            self._get_count(gid, uid) + 1, epoch]
+        await self._storage.incr_count(gid, uid, epoch)
+
+    def _get_pool(self, gid: Optional[str]) -> Pool:
+        '''
+            The basic pool (gid = None), or a group's pool over the basic pool and the group's menu
+        '''
+        if None not in self._pools:
+            self._pools[None] = CandidatePool(self._eating["basic_food"])
+
+        if gid not in self._pools:
+            self._pools[gid] = GroupPool(
+                self._pools[None], self._eating["group_food"].setdefault(gid, []))
+
+        return self._pools[gid]
+
+    @staticmethod
+    def _bag_key(gid: Optional[str], uid: str) -> Optional[str]:
+        '''
+            Key of the shuffle bag by what2eat_no_repeat, None if off. gid = None for private chats.
+        '''
+        if what2eat_config.what2eat_no_repeat == "off":
+            return None
+
+        prefix: str = "private" if gid is None else gid
+
+        return prefix if what2eat_config.what2eat_no_repeat == "group" else f"{prefix}:{uid}"
+
+    def _pick_food(self, pool: Pool, gid: Optional[str], uid: str) -> str:
+        key: Optional[str] = self._bag_key(gid, uid)
+
+        return pool.pick() if key is None else self._bags.pick(key, pool)
+
+    def _get_index(self, gid: Optional[str]) -> FoodIndex:
+        if gid not in self._indexes:
+            self._indexes[gid] = FoodIndex(
+                self._eating["basic_food"] if gid is None else self._eating["group_food"].get(gid, []))
+
+        return self._indexes[gid]
+
+    def _bump_version(self, gid: Optional[str]) -> None:
+        self._menu_versions[gid] = self._menu_versions.get(gid, 0) + 1
+
+    async def _add_food(self, gid: Optional[str], food: str) -> None:
+        '''
+            Add food to the basic menu (gid = None) or a group's menu, keeping pools and indexes up to date
+        '''
+        if gid is None:
+            self._eating["basic_food"].append(food)
+        else:
+            self._eating["group_food"][gid].append(food)
+
+        if gid in self._pools:
+            self._pools[gid].add(food)
+        if gid in self._indexes:
+            self._indexes[gid].add(food)
 
-    def get2eat(self, event: Union[PrivateMessageEvent, GroupMessageEvent]) -> Tuple[Message, MessageSegment]:
+        self._bump_version(gid)
+        await self._storage.add_food(gid, food)
+
+    async def _add_foods(self, gid: Optional[str], foods: List[str]) -> None:
+        '''
+            Add foods not in the menu yet, reported to the storage as one change
+        '''
+        for food in foods:
+            if gid is None:
+                self._eating["basic_food"].append(food)
+            else:
+                self._eating["group_food"][gid].append(food)
+
+            if gid in self._pools:
+                self._pools[gid].add(food)
+            if gid in self._indexes:
+                self._indexes[gid].add(food)
+
+        self._bump_version(gid)
+        await self._storage.add_foods(gid, foods)
+
+    async def _remove_food(self, gid: Optional[str], food: str) -> None:
+        if gid is None:
+            self._eating["basic_food"].remove(food)
+        else:
+            self._eating["group_food"][gid].remove(food)
+
+        if gid in self._pools:
+            self._pools[gid].remove(food)
+        if gid in self._indexes:
+            self._indexes[gid].remove(food)
+
+        self._bump_version(gid)
+        await self._storage.remove_food(gid, food)
+
+    async def _merge_basic_food(self, version: float, added: List[str], removed: List[str]) -> Tuple[int, int]:
+        '''
+            Remove then add foods of the basic menu if version is newer than local, keeping the local order
+        '''
+        if version <= self._eating.get("version", 0):
+            return 0, 0
+
+        index: FoodIndex = self._get_index(None)
+        n_removed: int = 0
+        for food in removed:
+            if food in index:
+                await self._remove_food(None, food)
+                n_removed += 1
+
+        # Added at once, one change to the storage however long the menu is
+        new_foods: List[str] = [
+            food for food in dict.fromkeys(added) if food not in index]
+        if new_foods:
+            await self._add_foods(None, new_foods)
+
+        self._eating["version"] = version
+        await self._storage.set_version(version)
+
+        return len(new_foods), n_removed
+
+    async def update_basic_food(self, entry: Optional[Dict[str, Any]]) -> MergeReport:
+        '''
+            Update the basic menu from repo. Apply the chain of deltas in entry of deltas.json if any,
+            otherwise get the latest eating.json and merge its "basic_food".
+        '''
+        cur_version: float = self._eating.get("version", 0)
+        chain: Optional[List[Dict[str, Any]]] = find_chain(entry, cur_version)
+
+        if chain is not None:
+            added: int = 0
+            removed: int = 0
+            for delta in chain:
+                n_added, n_removed = await self._merge_basic_food(
+                    delta["version"], delta.get("added", {}).get("basic_food", []), delta.get("removed", {}).get("basic_food", []))
+                added += n_added
+                removed += n_removed
+
+            return MergeReport("eating.json", "delta" if chain else "none", cur_version, self._eating["version"], added, removed)
+
+        response = await fetch_resource("eating.json", conditional=True)
+        if response is None:
+            return MergeReport("eating.json", "none", cur_version, cur_version, 0, 0)
+
+        added, _ = await self._merge_basic_food(response["version"], response.get("basic_food", []), [])
+        await commit_resource("eating.json")
+
+        return MergeReport("eating.json", "full" if added or response["version"] > cur_version else "none",
+                           cur_version, self._eating["version"], added, 0)
+
+    async def get2eat(self, event: Union[PrivateMessageEvent, GroupMessageEvent]) -> Tuple[Message, MessageSegment]:
         '''
             今天吃什么
         '''
         # Deal with private message event FIRST
         if isinstance(event, PrivateMessageEvent):
             if len(self._eating["basic_food"]) > 0:
-                return MessageSegment.text("建议") + Message(random.choice(self._eating["basic_food"]))
+                return MessageSegment.text("建议") + Message(
+                    self._images.compact(self._pick_food(self._get_pool(None), None, str(event.user_id))))
             else:
                 return MessageSegment.text("还没有菜单呢，就先饿着肚子吧，请[添加 菜名]🤤")
 
         uid: str = str(event.user_id)
         gid: str = str(event.group_id)
-        food_list: List[str] = []
 
-        self._eating = load_json(self._eating_json)
-        self._init_data(gid, uid)
+        await self._ensure_group(gid)
+        self._init_data(gid)
+        count: int = self._get_count(gid, uid)
 
         # Check whether is full of stomach
-        if self._eating["count"][gid][uid] >= what2eat_config.eating_limit:
-            save_json(self._eating_json, self._eating)
+        if count >= what2eat_config.eating_limit:
             return MessageSegment.text(random.choice(EatingEnough_List))
         else:
+            # 基础菜单与群菜单的并集
+            pool: Pool = self._get_pool(gid)
+
             # basic_food and group_food both are EMPTY
-            if len(self._eating["basic_food"]) == 0 and len(self._eating["group_food"][gid]) == 0:
+            if len(pool) == 0:
                 return MessageSegment.text("还没有菜单呢，就先饿着肚子吧，请[添加 菜名]🤤")
 
-            food_list = self._eating["basic_food"].copy()
-
-            # 取并集
-            if len(self._eating["group_food"][gid]) > 0:
-                food_list = list(set(food_list).union(
-                    set(self._eating["group_food"][gid])))
-
-            msg = MessageSegment.text("建议") + Message(random.choice(food_list))
-            self._eating["count"][gid][uid] += 1
-            save_json(self._eating_json, self._eating)
+            msg = MessageSegment.text(
+                "建议") + Message(self._images.compact(self._pick_food(pool, gid, uid)))
+            await self._incr_count(gid, uid)
 
             return msg
 
-    def get2drink(self, event: Union[PrivateMessageEvent, GroupMessageEvent]) -> MessageSegment:
+    async def get2drink(self, event: Union[PrivateMessageEvent, GroupMessageEvent]) -> MessageSegment:
         '''
             今天喝什么
         '''
         # Deal with private message event first
         if isinstance(event, PrivateMessageEvent):
-            _branch, _drink = self.pick_one_drink()
+            _branch, _drink = self.pick_one_drink(
+                self._bag_key(None, str(event.user_id)))
             return MessageSegment.text(random.choice(
                 [
                     f"不如来杯 {_branch} 的 {_drink} 吧！",
@@ -95,17 +526,16 @@ class EatingManager:
         uid: str = str(event.user_id)
         gid: str = str(event.group_id)
 
-        self._eating = load_json(self._eating_json)
-        self._init_data(gid, uid)
+        await self._ensure_group(gid)
+        self._init_data(gid)
+        count: int = self._get_count(gid, uid)
 
         # Check whether is full of stomach
-        if self._eating["count"][gid][uid] >= what2eat_config.eating_limit:
-            save_json(self._eating_json, self._eating)
+        if count >= what2eat_config.eating_limit:
             return MessageSegment.text(random.choice(DrinkingEnough_List))
         else:
-            _branch, _drink = self.pick_one_drink()
-            self._eating["count"][gid][uid] += 1
-            save_json(self._eating_json, self._eating)
+            _branch, _drink = self.pick_one_drink(self._bag_key(gid, uid))
+            await self._incr_count(gid, uid)
 
             return MessageSegment.text(random.choice(
                 [
@@ -141,31 +571,30 @@ class EatingManager:
         if _search == SearchLoc.IN_GROUP or _search == SearchLoc.IN_GLOBAL:
             if isinstance(gid, str):
                 if gid in self._eating["group_food"]:
-                    for food in self._eating["group_food"][gid]:
-                        # food is the full name or _food matches the food name before CQ code
-                        if _food == food or _food == food.split("[CQ:image")[0]:
-                            return FoodLoc.IN_GROUP, food
+                    # _food is the full name or matches the food name before CQ code
+                    food: Optional[str] = self._get_index(gid).find(_food)
+                    if food is not None:
+                        return FoodLoc.IN_GROUP, food
 
                     if _search == SearchLoc.IN_GROUP:
                         return FoodLoc.NOT_EXISTS, ""
 
         if _search == SearchLoc.IN_BASIC or _search == SearchLoc.IN_GLOBAL:
-            for food in self._eating["basic_food"]:
-                if _food == food or _food == food.split("[CQ:image")[0]:
-                    return FoodLoc.IN_BASIC, food
+            food: Optional[str] = self._get_index(None).find(_food)
+            if food is not None:
+                return FoodLoc.IN_BASIC, food
 
             return FoodLoc.NOT_EXISTS, ""
 
-    def add_group_food(self, event: GroupMessageEvent, new_food: str) -> str:
+    async def add_group_food(self, event: GroupMessageEvent, new_food: str) -> str:
         '''
             添加至群菜单
         '''
-        uid: str = str(event.user_id)
         gid: str = str(event.group_id)
         msg: str = ""
 
-        self._eating = load_json(self._eating_json)
-        self._init_data(gid, uid)
+        await self._ensure_group(gid)
+        self._init_data(gid)
         status, _ = self._is_food_exists(
             new_food, SearchLoc.IN_GLOBAL, gid)  # new food may include cq
 
@@ -175,17 +604,15 @@ class EatingManager:
             msg = f"已在群特色菜单中~"
         else:
             # If image included, save it, return the path in string
-            self._eating["group_food"][gid].append(new_food)
+            await self._add_food(gid, new_food)
             msg = f"已加入群特色菜单~"
 
-        save_json(self._eating_json, self._eating)
         return msg
 
-    def add_basic_food(self, new_food: str) -> str:
+    async def add_basic_food(self, new_food: str) -> str:
         '''
             添加至基础菜单
         '''
-        self._eating = load_json(self._eating_json)
         msg: str = ""
         status, _ = self._is_food_exists(
             new_food, SearchLoc.IN_BASIC, None)  # new food may include cq
@@ -194,13 +621,77 @@ class EatingManager:
             msg = f"已在基础菜单中~"
         else:
             # Even food is in groups' menu, it won't be affected when to pick
-            self._eating["basic_food"].append(new_food)
+            await self._add_food(None, new_food)
             msg = f"已加入基础菜单~"
 
-        save_json(self._eating_json, self._eating)
         return msg
 
-    def remove_food(self, event: GroupMessageEvent, food_to_remove: str) -> str:
+    async def import_foods(self, gid: Optional[str], foods: List[str]) -> Tuple[int, int]:
+        '''
+            Add foods to the basic menu (gid = None) or a group's menu at once, skipping those
+            already in the basic menu or the group's menu, like adding one by one.
+            Return numbers of foods added and skipped, at most IMPORT_LIMIT foods are taken.
+        '''
+        foods = foods[:IMPORT_LIMIT]
+        search: SearchLoc = SearchLoc.IN_BASIC
+        if gid is not None:
+            await self._ensure_group(gid)
+            self._init_data(gid)
+            search = SearchLoc.IN_GLOBAL
+
+        # Imported images are rewritten to plain CQ codes while foods added from messages nest theirs,
+        # so foods with images are also told apart by their name and image file
+        menu: List[str] = self._eating["basic_food"] + \
+            ([] if gid is None else self._eating["group_food"].get(gid, []))
+        images: Set[Tuple[str, str]] = {
+            image_key(food) for food in menu if "[CQ:image" in food}
+
+        # Foods in the batch are looked up the same way as in menus
+        batch: FoodIndex = FoodIndex()
+        new_foods: List[str] = []
+        for food in foods:
+            status, _ = self._is_food_exists(food, search, gid)
+            if status != FoodLoc.NOT_EXISTS or batch.find(food) is not None:
+                continue
+
+            if "[CQ:image" in food:
+                if image_key(food) in images:
+                    continue
+
+                images.add(image_key(food))
+
+            batch.add(food)
+            new_foods.append(food)
+
+        if new_foods:
+            await self._add_foods(gid, new_foods)
+
+        return len(new_foods), len(foods) - len(new_foods)
+
+    async def export_menu(self, gid: Optional[str], export_file: Path) -> int:
+        '''
+            Write the basic menu (gid = None) or a group's menu as text, one food per line, the same as
+            imported. Lines are written in chunks, so the menu is never rendered as a whole.
+            Return the number of foods.
+        '''
+        if gid is not None:
+            await self._ensure_group(gid)
+
+        # Only references are copied, the menu may change while writing
+        foods: List[str] = list(
+            self._eating["basic_food"] if gid is None else self._eating["group_food"].get(gid, []))
+        export_file.parent.mkdir(parents=True, exist_ok=True)
+        _tmp: Path = temp_file(export_file)
+
+        async with aiofiles.open(_tmp, "w", encoding="utf-8") as f:
+            for i in range(0, len(foods), 500):
+                await f.write("".join(food + "\n" for food in foods[i:i + 500]))
+
+        os.replace(_tmp, export_file)
+
+        return len(foods)
+
+    async def remove_food(self, event: GroupMessageEvent, food_to_remove: str) -> str:
         '''
             从基础菜单移除，需SUPERUSER 权限（群聊与私聊）
             从群菜单中移除，需GROUP_ADMIN | GROUP_OWNER 权限
@@ -211,31 +702,31 @@ class EatingManager:
         msg: str = ""
         res: bool = True
 
-        self._eating = load_json(self._eating_json)
-        self._init_data(gid, uid)
+        await self._ensure_group(gid)
+        self._init_data(gid)
         status, food_fullname = self._is_food_exists(
             food_to_remove, SearchLoc.IN_GLOBAL, gid)   # food_to_remove dosen't include cq
 
         if status == FoodLoc.IN_GROUP:
-            self._eating["group_food"][gid].remove(food_fullname)
+            await self._remove_food(gid, food_fullname)
             # Return the food name user input instead of full name
             msg = f"{food_to_remove} 已从群菜单中删除~"
         elif status == FoodLoc.IN_BASIC:
             if uid not in get_driver().config.superusers:
                 msg = f"{food_to_remove} 在基础菜单中，非超管不可操作哦~"
             else:
-                self._eating["basic_food"].remove(food_fullname)
+                await self._remove_food(None, food_fullname)
                 msg = f"{food_to_remove} 已从基础菜单中删除~"
         else:
             msg = f"{food_to_remove} 不在菜单中哦~"
 
         # If an image included, unlink it
         if "[CQ:image" in food_fullname:
-            res = delete_cq_image(food_fullname)
+            res = await run_sync(self._images.delete_cq_image, food_fullname)
             if res:
                 _deleted: Path = get_cq_image_path(food_fullname)
                 # Search all the foods with cq image path
-                _flag: bool = self._remove_food_matched(_deleted)
+                _flag: bool = await self._remove_food_matched(_deleted)
 
                 if _flag:
                     msg += f"\n相同配图的其他菜品一并被移除"
@@ -243,96 +734,143 @@ class EatingManager:
             if not res:
                 msg += "\n但配图删除出错，图片可能不存在"
 
-        save_json(self._eating_json, self._eating)
         return msg
 
-    def _remove_food_matched(self, _deleted: str) -> bool:
+    async def _remove_food_matched(self, _deleted: str) -> bool:
         '''
             Remove all the foods with the same image path
             Return whether other images removed
         '''
         _flag: bool = False
-        for food in self._eating["basic_food"]:
-            if _deleted in food:
-                self._eating["basic_food"].remove(food)
-                _flag = True
-
-        for gid in self._eating["group_food"]:
-            for food in self._eating["group_food"][gid]:
-                if _deleted in food:
-                    self._eating["group_food"][gid].remove(food)
+        # Matched first, _remove_food removes from the list being searched
+        for food in [food for food in self._eating["basic_food"] if _deleted in food]:
+            await self._remove_food(None, food)
+            _flag = True
+
+        # Groups may be evicted meanwhile if loaded lazily, they drop such foods once loaded again
+        for gid, foods in list(self._eating["group_food"].items()):
+            for food in [food for food in foods if _deleted in food]:
+                if gid in self._eating["group_food"]:
+                    await self._remove_food(gid, food)
                     _flag = True
 
         return _flag
 
-    def reset_count(self) -> None:
+    async def sweep_images(self) -> SweepReport:
         '''
-            Reset eating times in every eating time
+            Delete images no food refers to after what2eat_image_grace_hours, and beyond the quota.
+            Groups not resident are read from the storage, so every menu is searched.
         '''
-        self._eating = load_json(self._eating_json)
+        await self.sync()
+
+        referenced: Set[str] = set()
+        menus: List[List[str]] = [self._eating["basic_food"]]
+        menus.extend(self._eating["group_food"].values())
+        if self._storage.lazy:
+            for gid in await self._storage.list_groups():
+                if gid not in self._eating["group_food"]:
+                    foods, _ = await self._read_group(gid)
+                    menus.append(foods)
 
-        for gid in self._eating["count"]:
-            for uid in self._eating["count"][gid]:
-                self._eating["count"][gid][uid] = 0
+        for foods in menus:
+            for food in foods:
+                if "file://" in food and ".image" in food:
+                    referenced.add(Path(get_cq_image_path(food)).name)
 
-        save_json(self._eating_json, self._eating)
+        report: SweepReport = await run_sync(
+            self._images.sweep, referenced, what2eat_config.what2eat_image_grace_hours * 3600)
+        await run_sync(self._images.save_sizes)
 
-    def pick_one_drink(self) -> Tuple[str, str]:
-        _drinks: Dict[str, List[str]] = load_json(self._drinks_json)
-        _branch: str = random.choice(list(_drinks))
-        _drink: str = random.choice(_drinks[_branch])
+        return report
 
-        return _branch, _drink
+    def pick_one_drink(self, key: Optional[str] = None) -> Tuple[str, str]:
+        '''
+            Return (brand, drink), other than the last drink of the shuffle bag key if given
+        '''
+        if key is None:
+            return self._drinks.pick()
+
+        return self._bags.pick_drink(key, self._drinks.pick)
 
     # ------------------------- Menu -------------------------
-    def show_group_menu(self, gid: str) -> Tuple[bool, Union[Message, MessageSegment]]:
-        msg: str = ""
-        food_with_img: int = 0
-        self._eating = load_json(self._eating_json)
-        self._init_data(gid)
-        save_json(self._eating_json, self._eating)
+    def _render_menu(self, gid: Optional[str], title: str, foods: List[str]) -> Tuple[bool, List[Message]]:
+        '''
+            Return whether to send as forward message and the pages, cached until the menu version changes
+        '''
+        version: int = self._menu_versions.get(gid, 0)
+        cached: Optional[Tuple[int, Tuple[bool, List[Message]]]] = \
+            self._rendered.get(gid)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        food_with_img: int = sum("[CQ:image" in food for food in foods)
+        if food_with_img > 0:
+            foods = [self._images.compact(food) for food in foods]
+
+        is_too_many_lines: bool = len(foods) > 20 or (
+            food_with_img > 4 and len(foods) > 15)
+        if is_too_many_lines:
+            pages: List[str] = paginate_menu(
+                title, foods, what2eat_config.what2eat_menu_page_size)
+        else:
+            pages = ["\n".join([title] + foods)]
 
-        if len(self._eating["group_food"][gid]) > 0:
-            msg += f"---群特色菜单---"
-            for food in self._eating["group_food"][gid]:
-                msg += f"\n{food}"
-                if "[CQ:image" in food:
-                    food_with_img += 1
+        rendered: Tuple[bool, List[Message]] = (
+            is_too_many_lines, [Message(page) for page in pages])
+        self._rendered[gid] = (version, rendered)
 
-            return len(self._eating["group_food"][gid]) > 20 or (food_with_img > 4 and len(self._eating["group_food"][gid]) > 15), Message(msg)
+        return rendered
 
-        return 0, MessageSegment.text("还没有群特色菜单呢，请[添加 菜名]🤤")
+    async def show_group_menu(self, gid: str) -> Tuple[bool, List[Union[Message, MessageSegment]]]:
+        await self._ensure_group(gid)
+        group_food: List[str] = self._eating["group_food"].get(gid, [])
+        if len(group_food) > 0:
+            return self._render_menu(gid, "---群特色菜单---", group_food)
 
-    def show_basic_menu(self) -> Tuple[bool, Union[Message, MessageSegment]]:
-        msg: str = ""
-        food_with_img: int = 0
-        self._eating = load_json(self._eating_json)
+        return False, [MessageSegment.text("还没有群特色菜单呢，请[添加 菜名]🤤")]
 
+    def show_basic_menu(self) -> Tuple[bool, List[Union[Message, MessageSegment]]]:
         if len(self._eating["basic_food"]) > 0:
-            msg += f"---基础菜单---"
-            for food in self._eating["basic_food"]:
-                msg += f"\n{food}"
-                if "[CQ:image" in food:
-                    food_with_img += 1
+            return self._render_menu(None, "---基础菜单---", self._eating["basic_food"])
+
+        return False, [MessageSegment.text("还没有基础菜单呢，请[添加 菜名]🤤")]
 
-            return len(self._eating["basic_food"]) > 20 or (food_with_img > 4 and len(self._eating["basic_food"]) > 15), Message(msg)
+    async def search_food(self, event: Union[PrivateMessageEvent, GroupMessageEvent], keyword: str) -> Union[Message, MessageSegment]:
+        '''
+            Search the group's menu then the basic menu for foods whose name contains keyword
+        '''
+        results: List[str] = []
+        if isinstance(event, GroupMessageEvent):
+            gid: str = str(event.group_id)
+            await self._ensure_group(gid)
+            results += self._get_index(gid).search(keyword)
+
+        found: Set[str] = set(results)
+        results += [food for food in self._get_index(
+            None).search(keyword) if food not in found]
+
+        if len(results) == 0:
+            return MessageSegment.text(f"没有找到包含“{keyword}”的菜品")
 
-        return 0, MessageSegment.text("还没有基础菜单呢，请[添加 菜名]🤤")
+        msg: str = "\n".join(["---搜索结果---"] + [self._images.compact(food)
+                             for food in results[:SEARCH_LIMIT]])
+        if len(results) > SEARCH_LIMIT:
+            msg += f"\n……共{len(results)}个，仅显示前{SEARCH_LIMIT}个"
+
+        return Message(msg)
 
     # ------------------------- Greetings -------------------------
-    def update_greeting_status(self, gid: str, new_state: bool) -> None:
+    async def update_greeting_status(self, gid: str, new_state: bool) -> None:
         '''
             Turn on/off greeting tips in group
         '''
-        self._greetings = load_json(self._greetings_json)
-
         if new_state:
             self._greetings["groups_id"].update({gid: True})
         else:
             if gid in self._greetings["groups_id"]:
                 self._greetings["groups_id"].pop(gid)
 
-        save_json(self._greetings_json, self._greetings)
+        await self._storage.update_greeting_status(gid, new_state)
 
     def which_meals(self, input_cn: str) -> Optional[Meals]:
         '''
@@ -344,13 +882,12 @@ class EatingManager:
 
         return None
 
-    def add_greeting(self, meal: Meals, greeting: str) -> MessageSegment:
+    async def add_greeting(self, meal: Meals, greeting: str) -> MessageSegment:
         '''
             添加某一时段问候语
         '''
-        self._greetings = load_json(self._greetings_json)
         self._greetings[meal.value[0]].append(greeting)
-        save_json(self._greetings_json, self._greetings)
+        await self._storage.add_greeting(meal, greeting)
 
         return MessageSegment.text(f"{greeting} 已加入 {meal.value[1]} 问候~")
 
@@ -359,7 +896,6 @@ class EatingManager:
             展示某一时段问候语并标号
             等待用户输入标号，调用 remove_greeting 删除
         '''
-        self._greetings = load_json(self._greetings_json)
         msg: str = ""
         i: int = 1
 
@@ -373,18 +909,16 @@ class EatingManager:
 
         return MessageSegment.text(msg)
 
-    def remove_greeting(self, meal: Meals, index: int) -> MessageSegment:
+    async def remove_greeting(self, meal: Meals, index: int) -> MessageSegment:
         '''
             删除某一时段问候语
         '''
-        self._greetings = load_json(self._greetings_json)
-
         if index > len(self._greetings[meal.value[0]]):
             return MessageSegment.text("输入序号不合法")
         else:
             # Get the popped greeting to show
             greeting = self._greetings[meal.value[0]].pop(index-1)
-            save_json(self._greetings_json, self._greetings)
+            await self._storage.remove_greeting(meal, index)
 
         return MessageSegment.text(f"{greeting} 已从 {meal.value[1]} 问候中移除~")
 
@@ -395,17 +929,11 @@ class EatingManager:
             logger.warning(f"获取Bot失败：{e}")
             return
 
-        self._greetings = load_json(self._greetings_json)
         msg = self._get_greeting(meal)
 
         if isinstance(msg, MessageSegment) and bool(self._greetings["groups_id"]) > 0:
-            for gid in self._greetings["groups_id"]:
-                try:
-                    await bot.call_api("send_group_msg", group_id=int(gid), message=msg)
-                except ActionFailed as e:
-                    logger.warning(f"发送群 {gid} 失败：{e}")
-
-            logger.info(f"已群发{meal.value[1]}提醒")
+            report: BroadcastReport = await self._broadcaster.broadcast(bot, self._greetings["groups_id"], msg)
+            logger.info(f"已群发{meal.value[1]}提醒：{report}")
 
     def _get_greeting(self, meal: Meals) -> Optional[MessageSegment]:
         '''
@@ -0,0 +1,91 @@
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+
+class MergeReport(NamedTuple):
+    name: str
+    mode: str               # "delta", "full", or "none" if up to date
+    from_version: float
+    to_version: float
+    added: int
+    removed: int
+
+    def __str__(self) -> str:
+        if self.mode == "none":
+            return f"{self.name} is up to date, version: {self.to_version}"
+
+        return f"{self.name}: {self.mode} merge, version: {self.from_version} -> {self.to_version}, +{self.added} -{self.removed}"
+
+
+def find_chain(entry: Optional[Dict[str, Any]], version: float) -> Optional[List[Dict[str, Any]]]:
+    '''
+        Deltas of a resource in deltas.json to apply in order, from version up to the latest.
+        Return [] if up to date, or None if no chain reaches the latest, then a full merge is needed.
+
+        An entry of deltas.json looks like:
+        {
+            "version": 1.8,
+            "deltas": [
+                {"base": 1.7, "version": 1.8, "added": {"basic_food": [...]}, "removed": {"basic_food": [...]}}
+            ]
+        }
+    '''
+    if entry is None:
+        return None
+
+    latest: float = entry.get("version", 0)
+    if version >= latest:
+        return []
+
+    by_base: Dict[float, Dict[str, Any]] = {
+        delta["base"]: delta for delta in entry.get("deltas", [])}
+    chain: List[Dict[str, Any]] = []
+
+    while version < latest:
+        delta: Optional[Dict[str, Any]] = by_base.get(version)
+        if delta is None or delta["version"] <= version:
+            return None
+
+        chain.append(delta)
+        version = delta["version"]
+
+    return chain if version == latest else None
+
+
+def apply_list_delta(items: List[str], added: Iterable[str], removed: Iterable[str]) -> Tuple[List[str], int, int]:
+    '''
+        Remove then append items, keeping the order of the rest. Return the new list and numbers added and removed
+    '''
+    removed_set: Set[str] = set(removed)
+    kept: List[str] = [item for item in items if item not in removed_set]
+    present: Set[str] = set(kept)
+    new_items: List[str] = []
+
+    for item in added:
+        if item not in present:
+            present.add(item)
+            new_items.append(item)
+
+    return kept + new_items, len(items) - len(kept), len(new_items)
+
+
+def apply_dict_delta(data: Dict[str, Any], added: Dict[str, List[str]], removed: Dict[str, List[str]]) -> Tuple[Dict[str, Any], int, int]:
+    '''
+        Apply a delta to each list of the data, e.g. drinks of each brand, without changing the data.
+        Keys whose lists become empty by removal are dropped.
+    '''
+    merged: Dict[str, Any] = dict(data)
+    n_added: int = 0
+    n_removed: int = 0
+
+    for key in set(added) | set(removed):
+        items, n_rm, n_add = apply_list_delta(
+            merged.get(key, []), added.get(key, []), removed.get(key, []))
+        n_added += n_add
+        n_removed += n_rm
+
+        if items or key not in removed:
+            merged[key] = items
+        else:
+            merged.pop(key, None)
+
+    return merged, n_added, n_removed
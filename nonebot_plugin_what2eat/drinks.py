@@ -0,0 +1,116 @@
+import random
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from nonebot import logger
+
+from .utils import load_json
+
+
+class DrinkCatalog:
+    '''
+        drinks.json resident in memory, reloaded only when the file's mtime changes.
+        Drinks of all brands are flattened into arrays and sampled through an alias table in O(1):
+        - brand: uniform over brands, then uniform over drinks of the brand
+        - drink: uniform over all drinks
+        - custom: brands weighted by weights (1.0 if absent), then uniform over drinks of the brand
+    '''
+
+    def __init__(self, drinks_json: Path, mode: str = "brand", weights: Optional[Dict[str, float]] = None):
+        self._drinks_json: Path = drinks_json
+        self._mode: str = mode
+        self._weights: Dict[str, float] = weights or {}
+        self._mtime: float = -1
+
+        self._brands: List[str] = []
+        self._drinks: List[str] = []
+        self._brand_of: array = array("l")
+        self._prob: array = array("d")
+        self._alias: array = array("l")
+
+    def __len__(self) -> int:
+        self._reload_if_changed()
+        return len(self._drinks)
+
+    def _reload_if_changed(self) -> None:
+        mtime: float = self._drinks_json.stat().st_mtime
+        if mtime == self._mtime:
+            return
+
+        _drinks: Dict[str, List[str]] = load_json(self._drinks_json)
+        brands: List[str] = []
+        drinks: List[str] = []
+        brand_of: array = array("l")
+        weights: List[float] = []
+
+        for brand, _list in _drinks.items():
+            # Skip "version" and brands without drinks
+            if not isinstance(_list, list) or len(_list) == 0:
+                continue
+
+            if self._mode == "drink":
+                weight: float = 1.0
+            elif self._mode == "custom":
+                weight: float = self._weights.get(brand, 1.0) / len(_list)
+            else:
+                weight: float = 1.0 / len(_list)
+
+            for drink in _list:
+                brand_of.append(len(brands))
+                drinks.append(drink)
+                weights.append(weight)
+
+            brands.append(brand)
+
+        self._prob, self._alias = self._build_alias(weights)
+        self._brands, self._drinks, self._brand_of = brands, drinks, brand_of
+        self._mtime = mtime
+
+        logger.info(
+            f"Loaded {len(drinks)} drinks of {len(brands)} brands from {self._drinks_json.name}")
+
+    @staticmethod
+    def _build_alias(weights: List[float]) -> Tuple[array, array]:
+        '''
+            Vose's alias method
+        '''
+        n: int = len(weights)
+        prob: array = array("d", [1.0] * n)
+        alias: array = array("l", range(n))
+        total: float = sum(weights)
+        if n == 0 or total <= 0:
+            return prob, alias
+
+        scaled: List[float] = [w * n / total for w in weights]
+        small: List[int] = [i for i, p in enumerate(scaled) if p < 1.0]
+        large: List[int] = [i for i, p in enumerate(scaled) if p >= 1.0]
+
+        while small and large:
+            s: int = small.pop()
+            l: int = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+
+        # The rest are 1.0 up to floating point error
+        for i in small + large:
+            prob[i] = 1.0
+
+        return prob, alias
+
+    def pick(self) -> Tuple[str, str]:
+        '''
+            Return (brand, drink)
+        '''
+        self._reload_if_changed()
+
+        i: int = random.randrange(len(self._drinks))
+        if random.random() >= self._prob[i]:
+            i = self._alias[i]
+
+        return self._brands[self._brand_of[i]], self._drinks[i]
@@ -0,0 +1,469 @@
+import asyncio
+import hashlib
+import io
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import aiofiles
+from nonebot import logger
+from nonebot.adapters.onebot.v11 import Message, MessageSegment
+
+try:
+    from PIL import Image
+except ModuleNotFoundError:
+    Image = None
+
+from .config import downloader
+from .menu import get_plain_name
+from .metrics import image_bytes
+from .utils import get_cq_image_path, load_json, save_json, temp_file
+
+_DIGEST_NAME = re.compile(r"^[0-9a-f]{64}\.image$")
+# Files younger than this are never swept, they may be saved for a food not added yet
+_IN_FLIGHT: float = 60
+
+
+def _format_size(size: int) -> str:
+    return f"{size / (1 << 20):.1f}MB"
+
+
+class SweepReport(NamedTuple):
+    scanned: int
+    orphans: int            # Files no food refers to
+    deleted: int
+    reclaimed: int          # Bytes
+    total: int              # Bytes of img/ after sweeping
+    quota: int              # 0 if unlimited
+
+    def __str__(self) -> str:
+        msg: str = f"共{self.scanned}个图片文件，{self.orphans}个未被引用，删除{self.deleted}个，释放{_format_size(self.reclaimed)}，现占用{_format_size(self.total)}"
+        if self.quota > 0:
+            msg += f"/{_format_size(self.quota)}"
+            if self.total > self.quota:
+                msg += "，仍超出配额"
+
+        return msg
+
+
+def compress_image(data: bytes, max_size: int, quality: int) -> Optional[bytes]:
+    '''
+        Downscale the image to fit in max_size x max_size and recompress it, as JPEG or as PNG
+        if it has transparency. Run in a worker thread. Animated images are left as they are.
+        Return None if it can't be decoded or doesn't get smaller.
+    '''
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if getattr(img, "is_animated", False):
+                return None
+
+            # Let JPEG decode at a reduced scale
+            img.draft("RGB", (max_size, max_size))
+            img.thumbnail((max_size, max_size))
+            out = io.BytesIO()
+            if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+                img.save(out, "PNG", optimize=True)
+            else:
+                img.convert("RGB").save(out, "JPEG", quality=quality,
+                                        optimize=True, progressive=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    compact: bytes = out.getvalue()
+
+    return compact if len(compact) < len(data) else None
+
+
+class ImageStore:
+    '''
+        Images of foods under img/, named by the SHA-256 of their content as "<sha256>.image".
+        The same picture uploaded to many groups is stored once. The names are indexed in
+        memory when loaded, so checking whether an image exists costs no directory scan.
+
+        If max_size > 0 and Pillow is installed, every image is also downscaled and recompressed
+        into compact/ by a pool of worker threads, as Pillow releases the GIL while coding, and menus
+        are sent with the compact version. Sizes of the original and the compact version are
+        recorded in sizes.json, the compact size equals the original if it couldn't be smaller.
+
+        If quota > 0, new images are refused while img/ takes more than quota bytes.
+    '''
+
+    def __init__(self, img_dir: Path, max_size: int = 0, quality: int = 80, workers: int = 2, quota: int = 0):
+        self._img_dir: Path = img_dir
+        self._compact_dir: Path = img_dir / "compact"
+        self._sizes_json: Path = img_dir / "sizes.json"
+        self._max_size: int = max_size if Image is not None else 0
+        self._quality: int = quality
+        self._workers: int = max(1, workers)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._digests: Set[str] = set()
+        # Digest -> [original size, compact size]
+        self._sizes: Dict[str, List[int]] = {}
+        self._sizes_dirty: bool = False
+        self._quota: int = quota
+        # Bytes of img/, tracked only if quota > 0
+        self._total: int = 0
+        if max_size > 0 and Image is None:
+            logger.warning(
+                "Package Pillow is not installed, images are stored as uploaded")
+        # Client filenames seen before, e.g. "{md5}.image" from QQ, to skip downloading
+        self._aliases: Dict[str, str] = {}
+        # Legacy image paths already migrated to their content address
+        self._migrated: Dict[str, str] = {}
+
+    def load(self) -> None:
+        self._img_dir.mkdir(parents=True, exist_ok=True)
+        self._digests = {f.stem for f in self._img_dir.iterdir()
+                         if f.is_file() and _DIGEST_NAME.match(f.name)}
+        self._aliases.clear()
+
+        self._sizes = {}
+        if self._sizes_json.exists():
+            try:
+                self._sizes = load_json(self._sizes_json)
+            except ValueError:
+                logger.warning(
+                    f"{self._sizes_json.name} is broken, images will be compressed again")
+
+        # Compact versions deleted by hand are made again
+        compacted: Set[str] = set()
+        if self._compact_dir.is_dir():
+            compacted = {f.stem for f in self._compact_dir.iterdir()}
+        self._sizes = {digest: sizes for digest, sizes in self._sizes.items()
+                       if digest in self._digests and (sizes[1] == sizes[0] or digest in compacted)}
+
+        if self._quota > 0:
+            self._total = sum(size for _, size, _ in self._scan())
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self._digests
+
+    def is_missing(self, food: str) -> bool:
+        '''
+            Whether the food refers to a content addressed image which doesn't exist
+        '''
+        if "file://" not in food or ".image" not in food:
+            return False
+
+        _path: Path = Path(get_cq_image_path(food))
+
+        return _DIGEST_NAME.match(_path.name) is not None and _path.stem not in self._digests
+
+    def path_of(self, digest: str) -> Path:
+        return self._img_dir / f"{digest}.image"
+
+    async def save(self, data: bytes) -> Path:
+        '''
+            Store the image unless the same content exists, return its path
+        '''
+        digest: str = hashlib.sha256(data).hexdigest()
+        filepath: Path = self.path_of(digest)
+
+        if digest not in self._digests:
+            _tmp: Path = temp_file(filepath)
+            async with aiofiles.open(_tmp, "wb") as f:
+                await f.write(data)
+
+            os.replace(_tmp, filepath)
+            self._digests.add(digest)
+            self._total += len(data)
+        else:
+            self._touch(filepath)
+
+        if self._max_size > 0 and digest not in self._sizes:
+            await self._compact(digest, data)
+
+        return filepath
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        '''
+            Threads rather than processes: forking the bot would hand file_lock, if held, to the workers
+        '''
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self._workers, thread_name_prefix="what2eat-image")
+
+        return self._executor
+
+    async def _compact(self, digest: str, data: bytes) -> None:
+        compact: Optional[bytes] = await asyncio.get_running_loop().run_in_executor(
+            self._get_executor(), compress_image, data, self._max_size, self._quality)
+
+        if compact is not None:
+            self._compact_dir.mkdir(parents=True, exist_ok=True)
+            filepath: Path = self._compact_dir / f"{digest}.image"
+            _tmp: Path = temp_file(filepath)
+            async with aiofiles.open(_tmp, "wb") as f:
+                await f.write(compact)
+
+            os.replace(_tmp, filepath)
+            self._total += len(compact)
+
+        self._sizes[digest] = [len(data), len(
+            compact) if compact is not None else len(data)]
+        self._sizes_dirty = True
+        image_bytes.inc(len(data), kind="original")
+        image_bytes.inc(self._sizes[digest][1], kind="compact")
+
+    async def compact_all(self) -> int:
+        '''
+            Compress images stored before compression was on, as many at a time as workers.
+            Return the number of images compressed.
+        '''
+        if self._max_size <= 0:
+            return 0
+
+        todo: List[str] = [
+            digest for digest in self._digests if digest not in self._sizes]
+        for i in range(0, len(todo), self._workers):
+            await asyncio.gather(*[self._compact_file(digest) for digest in todo[i:i + self._workers]])
+
+        if todo:
+            logger.info(f"Compressed {len(todo)} images")
+
+        return len(todo)
+
+    async def _compact_file(self, digest: str) -> None:
+        try:
+            async with aiofiles.open(self.path_of(digest), "rb") as f:
+                data: bytes = await f.read()
+        except FileNotFoundError:
+            return
+
+        await self._compact(digest, data)
+
+    def save_sizes(self) -> None:
+        if not self._sizes_dirty:
+            return
+
+        self._sizes_dirty = False
+        save_json(self._sizes_json, self._sizes)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def compact(self, food: str) -> str:
+        '''
+            The food with its image replaced by the compact version, if any
+        '''
+        if "file://" not in food or ".image" not in food:
+            return food
+
+        _path: str = get_cq_image_path(food)
+        digest: str = Path(_path).stem
+        sizes: Optional[List[int]] = self._sizes.get(digest)
+        if sizes is None or sizes[1] == sizes[0]:
+            return food
+
+        return food.replace(_path, str((self._compact_dir / f"{digest}.image").resolve()))
+
+    @property
+    def over_quota(self) -> bool:
+        return self._quota > 0 and self._total >= self._quota
+
+    @staticmethod
+    def _touch(filepath: Path) -> None:
+        '''
+            Referred again, e.g. the same picture uploaded, so an orphan is kept for another grace period
+        '''
+        try:
+            os.utime(filepath)
+        except FileNotFoundError:
+            pass
+
+    async def save_cq_image(self, msg: Message) -> bool:
+        '''
+            Save images in the message, then point them to the stored files.
+            Return False if an image isn't stored for img/ is over quota.
+        '''
+        for msg_seg in msg:
+            if msg_seg.type == "image":
+                filename = msg_seg.data.get("file", False)
+                if filename is False:
+                    continue
+
+                digest: Optional[str] = self._aliases.get(filename)
+                if digest is not None and digest in self._digests:
+                    filepath: Path = self.path_of(digest)
+                    self._touch(filepath)
+                elif self.over_quota:
+                    return False
+                else:
+                    url = msg_seg.data.get("url", False)
+                    if url is False:
+                        continue
+
+                    data = await downloader.get_bytes(url)
+                    if not data:
+                        continue
+
+                    filepath: Path = await self.save(data)
+                    self._aliases[filename] = filepath.stem
+
+                msg_seg.data["file"] = MessageSegment.image(filepath)
+
+        return True
+
+    def _scan(self) -> List[Tuple[Path, int, float]]:
+        '''
+            (path, size, mtime) of the files of images and compact versions, and temporary files
+        '''
+        files: List[Tuple[Path, int, float]] = []
+        for _dir in (self._img_dir, self._compact_dir):
+            if not _dir.is_dir():
+                continue
+
+            with os.scandir(_dir) as it:
+                for entry in it:
+                    if not entry.is_file() or entry.name == self._sizes_json.name:
+                        continue
+
+                    try:
+                        st: os.stat_result = entry.stat()
+                    except FileNotFoundError:
+                        continue
+
+                    files.append((Path(entry.path), st.st_size, st.st_mtime))
+
+        return files
+
+    def sweep(self, referenced: Set[str], grace: float) -> SweepReport:
+        '''
+            Delete files under img/ whose names aren't in referenced, i.e. no food refers to them,
+            once not modified for grace seconds. Compact versions go with their originals.
+            While over quota, younger orphans are deleted too, the oldest first.
+        '''
+        now: float = time.time()
+        files: List[Tuple[Path, int, float]] = self._scan()
+        total: int = sum(size for _, size, _ in files)
+        orphans: List[Tuple[Path, int, float]] = sorted(
+            (f for f in files if f[0].name not in referenced), key=lambda f: f[2])
+
+        deleted: int = 0
+        reclaimed: int = 0
+        for _path, size, mtime in orphans:
+            over_quota: bool = self._quota > 0 and total > self._quota
+            if now - mtime < (_IN_FLIGHT if over_quota else max(grace, _IN_FLIGHT)):
+                continue
+
+            try:
+                _path.unlink()
+            except FileNotFoundError:
+                continue
+
+            if _path.parent == self._img_dir:
+                self._digests.discard(_path.stem)
+                if self._sizes.pop(_path.stem, None) is not None:
+                    self._sizes_dirty = True
+
+            deleted += 1
+            reclaimed += size
+            total -= size
+
+        self._total = total
+        if deleted > 0:
+            logger.info(
+                f"Swept {deleted} orphan images, {reclaimed} bytes reclaimed")
+
+        return SweepReport(len(files), len(orphans), deleted, reclaimed, total, self._quota)
+
+    def _in_img_dir(self, _path: Path) -> bool:
+        return _path.parent.resolve() == self._img_dir.resolve()
+
+    def stored_food(self, food: str) -> Optional[str]:
+        '''
+            The food as one word and the CQ code of an image stored here, e.g. as exported or saved
+            by save_cq_image, rewritten to a plain CQ code of the stored file. None if it's anything
+            else: CQ codes from uploaded files would otherwise send, move or delete any file or URL.
+        '''
+        plain: str = get_plain_name(food)
+        if len(plain.split()) != 1 or "[CQ:" in plain or "file://" in plain:
+            return None
+
+        msg: Message = Message(food[len(plain):])
+        if len(msg) != 1 or msg[0].type != "image":
+            return None
+
+        _file: str = msg[0].data.get("file", "")
+        # save_cq_image nests the CQ code of the stored file in "file"
+        if _file.startswith("[CQ:"):
+            inner: Message = Message(_file)
+            if len(inner) != 1 or inner[0].type != "image":
+                return None
+
+            _file = inner[0].data.get("file", "")
+
+        if not _file.startswith("file://"):
+            return None
+
+        _path: Path = Path(_file[len("file://"):])
+        if not _DIGEST_NAME.match(_path.name) or _path.stem not in self._digests or not self._in_img_dir(_path):
+            return None
+
+        return plain + str(MessageSegment.image(self.path_of(_path.stem)))
+
+    def delete_cq_image(self, str_cq: str) -> bool:
+        _start: int = str_cq.find("file://")
+        if _start == -1 or "[CQ:image" not in str_cq:
+            return False
+
+        _end: int = str_cq.find(".image")
+        if _end == -1:
+            return False
+
+        delete_path: Path = Path(get_cq_image_path(str_cq))
+        # Only images stored here, whatever the food says
+        if not self._in_img_dir(delete_path):
+            return False
+
+        self._digests.discard(delete_path.stem)
+        sizes: Optional[List[int]] = self._sizes.pop(delete_path.stem, None)
+        if sizes is not None:
+            self._sizes_dirty = True
+            if sizes[1] < sizes[0]:
+                (self._compact_dir / delete_path.name).unlink(missing_ok=True)
+                self._total -= sizes[1]
+
+        if not delete_path.is_file():
+            return False
+
+        self._total -= delete_path.stat().st_size
+        delete_path.unlink()
+
+        return not delete_path.is_file()
+
+    def migrate(self, food: str) -> str:
+        '''
+            Move an image stored under its client filename to its content address.
+            Return the food with the image path replaced, or as it is if nothing to migrate.
+        '''
+        if "file://" not in food or ".image" not in food or "[CQ:image" not in food:
+            return food
+
+        old_path: str = get_cq_image_path(food)
+        # The same file may be referred by several foods
+        if old_path in self._migrated:
+            return food.replace(old_path, self._migrated[old_path])
+
+        _old: Path = Path(old_path)
+        if _DIGEST_NAME.match(_old.name) or not self._in_img_dir(_old) or not _old.is_file():
+            return food
+
+        digest: str = hashlib.sha256(_old.read_bytes()).hexdigest()
+        new_path: Path = self.path_of(digest).resolve()
+
+        if digest in self._digests:
+            _old.unlink()
+        else:
+            os.replace(_old, new_path)
+            self._digests.add(digest)
+
+        self._migrated[old_path] = str(new_path)
+        logger.info(f"Migrated image {_old.name} -> {new_path.name}")
+
+        return food.replace(old_path, str(new_path))
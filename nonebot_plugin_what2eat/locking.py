@@ -0,0 +1,77 @@
+import asyncio
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator, Optional
+
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
+
+from .utils import run_sync
+
+
+class FileLock:
+    '''
+        Advisory lock between processes sharing what2eat_path, by flock(2) on a lock file.
+        Data files are replaced by renaming, so the lock is taken on a file of its own.
+        Coroutines of a process take turns by an asyncio lock before a thread blocks on flock.
+        Not reentrant. A no-op where fcntl is unavailable, e.g. Windows.
+    '''
+
+    def __init__(self, _file: Path):
+        self._file: Path = _file
+        self._lock: Optional[asyncio.Lock] = None
+        self._f: Optional[IO] = None
+
+    def _acquire(self) -> IO:
+        self._file.parent.mkdir(parents=True, exist_ok=True)
+        f: IO = open(self._file, "a")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            f.close()
+            raise
+
+        return f
+
+    @staticmethod
+    def _release(f: IO) -> None:
+        # Closing the file releases the lock
+        f.close()
+
+    @contextmanager
+    def hold(self) -> Iterator[None]:
+        '''
+            Hold the lock in a blocking thread, e.g. the executor
+        '''
+        if fcntl is None:
+            yield
+            return
+
+        f: IO = self._acquire()
+        try:
+            yield
+        finally:
+            self._release(f)
+
+    async def __aenter__(self) -> "FileLock":
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        await self._lock.acquire()
+        if fcntl is not None:
+            try:
+                self._f = await run_sync(self._acquire)
+            except BaseException:
+                self._lock.release()
+                raise
+
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        if self._f is not None:
+            self._release(self._f)
+            self._f = None
+
+        self._lock.release()
@@ -0,0 +1,346 @@
+import json
+import os
+import random
+import zlib
+from typing import (Any, Callable, Dict, Iterable, List, Optional, Set, Tuple,
+                    Union)
+
+# At most this many images in one page of a menu
+MENU_PAGE_IMAGES: int = 10
+# At most this many foods in a search result
+SEARCH_LIMIT: int = 30
+# At most this many foods, and a file of this size, in an import
+IMPORT_LIMIT: int = 2000
+IMPORT_MAX_BYTES: int = 1 << 20
+
+
+def get_plain_name(food: str) -> str:
+    '''
+        The food name before CQ code, i.e. without its image
+    '''
+    return food.split("[CQ:image")[0]
+
+
+def image_key(food: str) -> Tuple[str, str]:
+    '''
+        The name and the image file of a food with an image, however its CQ code is written
+    '''
+    return get_plain_name(food), os.path.basename(food[food.find("file://") + 7: food.find(".image") + 6])
+
+
+def paginate_menu(title: str, foods: List[str], page_size: int) -> List[str]:
+    '''
+        Render the menu as pages of at most page_size foods and MENU_PAGE_IMAGES images,
+        the title heads the first page
+    '''
+    chunks: List[List[str]] = []
+    chunk: List[str] = []
+    images: int = 0
+
+    for food in foods:
+        image: bool = "[CQ:image" in food
+        if chunk and (len(chunk) >= page_size or images + image > MENU_PAGE_IMAGES):
+            chunks.append(chunk)
+            chunk = []
+            images = 0
+
+        chunk.append(food)
+        images += image
+
+    chunks.append(chunk)
+    chunks[0] = [title] + chunks[0]
+
+    return ["\n".join(c) for c in chunks]
+
+
+def parse_foods(lines: Iterable[str], stored_food: Callable[[str], Optional[str]]) -> Tuple[List[str], int]:
+    '''
+        Foods to import, one per line or separated by whitespace, in CQ code as menus store them.
+        A line with CQ code is one food, i.e. one word and the image, which stored_food checks to be
+        stored and rewrites, or returns None for. Words looking like image paths are not foods.
+        Return the foods deduplicated in order, and the number of lines not understood.
+    '''
+    foods: Dict[str, None] = {}
+    invalid: int = 0
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        if "[CQ:" in line:
+            food: Optional[str] = stored_food(line)
+            if food is not None:
+                foods[food] = None
+            else:
+                invalid += 1
+        elif "file://" in line:
+            invalid += 1
+        else:
+            for food in line.split():
+                foods[food] = None
+
+    return list(foods), invalid
+
+
+def parse_menu_file(name: str, data: bytes, stored_food: Callable[[str], Optional[str]]) -> Tuple[List[str], int]:
+    '''
+        Foods in an uploaded file: a JSON array of foods if named "*.json", otherwise text as exported
+    '''
+    try:
+        text: str = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        # Saved by Notepad on Chinese Windows
+        text: str = data.decode("gb18030", errors="replace")
+
+    if not name.lower().endswith(".json"):
+        return parse_foods(text.splitlines(), stored_food)
+
+    try:
+        items: Any = json.loads(text)
+    except ValueError:
+        return [], 1
+
+    if not isinstance(items, list):
+        return [], 1
+
+    foods, invalid = parse_foods(
+        (item for item in items if isinstance(item, str)), stored_food)
+
+    return foods, invalid + sum(not isinstance(item, str) for item in items)
+
+
+def get_grams(text: str) -> Set[str]:
+    '''
+        Unigrams and bigrams of the lowercased text
+    '''
+    text = text.lower()
+
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class FoodIndex:
+    '''
+        Hash index of a menu, from full name or plain name to the full name.
+        Several foods may share a plain name with different images, the earliest added is found first.
+        Plain names are also indexed by their unigrams and bigrams for substring search.
+        A menu may list a food more than once, so foods are counted and stay until every copy is removed.
+    '''
+
+    def __init__(self, foods: Iterable[str] = ()):
+        # Full name to the number of copies in the menu
+        self._full: Dict[str, int] = {}
+        self._plain: Dict[str, List[str]] = {}
+        self._grams: Dict[str, Set[str]] = {}
+
+        for food in foods:
+            self.add(food)
+
+    def __len__(self) -> int:
+        return len(self._full)
+
+    def __contains__(self, food: str) -> bool:
+        return food in self._full
+
+    def add(self, food: str) -> None:
+        if food in self._full:
+            self._full[food] += 1
+            return
+
+        self._full[food] = 1
+        plain: str = get_plain_name(food)
+        if plain not in self._plain:
+            self._plain[plain] = []
+            for gram in get_grams(plain):
+                self._grams.setdefault(gram, set()).add(plain)
+
+        self._plain[plain].append(food)
+
+    def remove(self, food: str) -> None:
+        if food not in self._full:
+            return
+
+        self._full[food] -= 1
+        if self._full[food] > 0:
+            return
+
+        self._full.pop(food)
+        plain: str = get_plain_name(food)
+        self._plain[plain].remove(food)
+        if not self._plain[plain]:
+            self._plain.pop(plain)
+            for gram in get_grams(plain):
+                self._grams[gram].discard(plain)
+                if not self._grams[gram]:
+                    self._grams.pop(gram)
+
+    def find(self, name: str) -> Optional[str]:
+        '''
+            Return the full name of the food if name is its full name or plain name
+        '''
+        foods: Optional[List[str]] = self._plain.get(name)
+        if foods:
+            return foods[0]
+
+        return name if name in self._full else None
+
+    def search(self, keyword: str) -> List[str]:
+        '''
+            Full names of the foods whose plain name contains keyword, case insensitive, shorter names first
+        '''
+        keyword = keyword.lower()
+        if not keyword:
+            return []
+
+        grams: List[str] = [keyword] if len(keyword) == 1 else \
+            [keyword[i:i + 2] for i in range(len(keyword) - 1)]
+        postings: List[Set[str]] = []
+        for gram in grams:
+            if gram not in self._grams:
+                return []
+
+            postings.append(self._grams[gram])
+
+        # Intersect from the rarest gram, then verify as bigrams may match out of order
+        postings.sort(key=len)
+        plains: Set[str] = postings[0].intersection(*postings[1:])
+
+        return [food for plain in sorted((p for p in plains if keyword in p.lower()), key=lambda p: (len(p), p))
+                for food in self._plain[plain]]
+
+
+class CandidatePool:
+    '''
+        Deduplicated foods to pick from, e.g. the basic menu. Add, remove and pick are all O(1).
+        A menu may list a food more than once, so it is reference counted and stays until every
+        copy is removed. version counts the changes, so that views over the pool know when it's changed.
+    '''
+
+    def __init__(self, foods: Iterable[str] = ()):
+        self._foods: List[str] = []
+        self._index: Dict[str, int] = {}
+        self._refs: Dict[str, int] = {}
+        self._fingerprint: Optional[int] = None
+        self.version: int = 0
+
+        for food in foods:
+            self.add(food)
+
+    def __len__(self) -> int:
+        return len(self._foods)
+
+    def __contains__(self, food: str) -> bool:
+        return food in self._index
+
+    def __getitem__(self, i: int) -> str:
+        return self._foods[i]
+
+    def fingerprint(self) -> int:
+        '''
+            CRC32 of the foods in order, computed once after every change
+        '''
+        if self._fingerprint is None:
+            self._fingerprint = zlib.crc32(
+                "\n".join(self._foods).encode("utf-8"))
+
+        return self._fingerprint
+
+    def add(self, food: str) -> None:
+        if food in self._index:
+            self._refs[food] += 1
+            return
+
+        self._fingerprint = None
+        self.version += 1
+        self._index[food] = len(self._foods)
+        self._refs[food] = 1
+        self._foods.append(food)
+
+    def remove(self, food: str) -> None:
+        if food not in self._index:
+            return
+
+        self._refs[food] -= 1
+        if self._refs[food] > 0:
+            return
+
+        # Move the last food into the hole so that the list stays dense
+        self._fingerprint = None
+        self.version += 1
+        i: int = self._index.pop(food)
+        self._refs.pop(food)
+        last: str = self._foods.pop()
+        if last != food:
+            self._foods[i] = last
+            self._index[last] = i
+
+    def pick(self) -> str:
+        return random.choice(self._foods)
+
+
+class GroupPool:
+    '''
+        Foods to pick from in a group: the basic pool shared by all groups, then the group's own
+        foods not in the basic menu, so that basic foods aren't copied into every group.
+        Index i < len(basic) is a basic food, and the group's own foods follow.
+        Once the basic pool changes, the group's own foods are filtered again on next use,
+        so editing the basic menu never walks the pools of groups.
+    '''
+
+    def __init__(self, basic: CandidatePool, foods: List[str]):
+        self._basic: CandidatePool = basic
+        # The group's menu as stored, not copied
+        self._foods: List[str] = foods
+        self._own: CandidatePool = CandidatePool()
+        self._version: int = -1
+
+    def _own_pool(self) -> CandidatePool:
+        if self._version != self._basic.version:
+            self._own = CandidatePool(
+                food for food in self._foods if food not in self._basic)
+            self._version = self._basic.version
+
+        return self._own
+
+    def __len__(self) -> int:
+        return len(self._basic) + len(self._own_pool())
+
+    def __contains__(self, food: str) -> bool:
+        return food in self._basic or food in self._own_pool()
+
+    def __getitem__(self, i: int) -> str:
+        n: int = len(self._basic)
+
+        return self._basic[i] if i < n else self._own_pool()[i - n]
+
+    def fingerprint(self) -> int:
+        '''
+            CRC32 of the group's own foods, chained from the fingerprint of the basic pool
+        '''
+        return zlib.crc32(self._own_pool().fingerprint().to_bytes(4, "little"), self._basic.fingerprint())
+
+    def add(self, food: str) -> None:
+        '''
+            The food is added to the group's menu
+        '''
+        if self._version != self._basic.version:
+            # Filtered again from the menu, which has the food already
+            self._own_pool()
+        elif food not in self._basic:
+            self._own.add(food)
+
+    def remove(self, food: str) -> None:
+        '''
+            The food is removed from the group's menu
+        '''
+        if self._version != self._basic.version:
+            self._own_pool()
+        else:
+            self._own.remove(food)
+
+    def pick(self) -> str:
+        return self[random.randrange(len(self))]
+
+
+# Either pool supports len, indexing, pick and fingerprint, see ShuffleBags
+Pool = Union[CandidatePool, GroupPool]
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+_LabelKey = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(key: _LabelKey, extra: Sequence[Tuple[str, str]] = ()) -> str:
+    pairs: List[Tuple[str, str]] = list(key) + list(extra)
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name: str = name
+        self.documentation: str = documentation
+        self._values: Dict[_LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels: str) -> None:
+        key: _LabelKey = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> List[str]:
+        lines: List[str] = [
+            f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(
+                    f"{self.name}{_format_labels(key)} {_format_value(value)}")
+
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name: str = name
+        self.documentation: str = documentation
+        self._buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        # Label key -> [count of each bucket..., sum, count]
+        self._series: Dict[_LabelKey, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key: _LabelKey = tuple(sorted(labels.items()))
+        with self._lock:
+            series: List[float] = self._series.setdefault(
+                key, [0] * (len(self._buckets) + 2))
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    series[i] += 1
+
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        '''
+            Observe the seconds spent in the block, even if it raises
+        '''
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines: List[str] = [
+            f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self._buckets, series):
+                    lines.append(
+                        f"{self.name}_bucket{_format_labels(key, [('le', repr(bound))])} {_format_value(count)}")
+
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {_format_value(series[-1])}")
+                lines.append(
+                    f"{self.name}_sum{_format_labels(key)} {repr(series[-2])}")
+                lines.append(
+                    f"{self.name}_count{_format_labels(key)} {_format_value(series[-1])}")
+
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[object] = []
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        metric = Counter(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        '''
+            Prometheus text exposition format
+        '''
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines += metric.render()
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_seconds: Histogram = registry.histogram(
+    "what2eat_handler_seconds", "Latency of what2eat matchers")
+json_seconds: Histogram = registry.histogram(
+    "what2eat_json_seconds", "Seconds spent loading or saving JSON files")
+json_bytes: Counter = registry.counter(
+    "what2eat_json_bytes_total", "Bytes of JSON files loaded or saved")
+journal_bytes: Counter = registry.counter(
+    "what2eat_journal_bytes_total", "Bytes appended to the journal")
+http_seconds: Histogram = registry.histogram(
+    "what2eat_http_seconds", "Seconds of HTTP downloads including retries")
+broadcast_seconds: Histogram = registry.histogram(
+    "what2eat_broadcast_seconds", "Seconds until a greeting broadcast reaches the last group",
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+broadcast_groups: Counter = registry.counter(
+    "what2eat_broadcast_groups_total", "Groups a greeting broadcast is sent to, by result")
+broadcast_retries: Counter = registry.counter(
+    "what2eat_broadcast_retries_total", "Retried sends of greeting broadcasts")
+image_bytes: Counter = registry.counter(
+    "what2eat_image_bytes_total", "Bytes of images compressed, by original or compact size")
+
+
+async def _handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body: bytes = registry.render().encode("utf-8")
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+class Exporter:
+    '''
+        A minimal HTTP server answering every request with the metrics text, for Prometheus to scrape
+    '''
+
+    def __init__(self, host: str, port: Optional[int]):
+        self._host: str = host
+        self._port: Optional[int] = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        if self._port is not None and self._server is None:
+            self._server = await asyncio.start_server(_handle_scrape, self._host, self._port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
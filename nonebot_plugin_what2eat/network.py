@@ -0,0 +1,182 @@
+import asyncio
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import httpx
+from nonebot import logger
+
+from .metrics import http_seconds
+from .utils import load_json, save_json
+
+
+class Downloader:
+    '''
+        One httpx.AsyncClient shared by the plugin, created on startup and closed on shutdown.
+        Connections are kept alive and pooled, at most concurrency requests are in flight, and
+        failed requests are retried with exponential backoff and full jitter.
+    '''
+
+    def __init__(self, timeout: float = 10.0, retries: int = 3, backoff: float = 0.5, concurrency: int = 8):
+        self._timeout: float = timeout
+        self._retries: int = retries
+        self._backoff: float = backoff
+        self._concurrency: int = concurrency
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def startup(self) -> None:
+        if self._client is not None:
+            return
+
+        self._client = httpx.AsyncClient(
+            timeout=self._timeout,
+            limits=httpx.Limits(
+                max_connections=self._concurrency, max_keepalive_connections=self._concurrency),
+            follow_redirects=True
+        )
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+
+    async def shutdown(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._semaphore = None
+
+    def _delay(self, attempt: int) -> float:
+        '''
+            Full jitter: uniform in [0, backoff * 2^attempt], capped at 30 seconds
+        '''
+        return random.uniform(0, min(30.0, self._backoff * 2 ** attempt))
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None) -> Optional[httpx.Response]:
+        '''
+            GET the url, return the response if 200 OK or 304 Not Modified, otherwise None after retries.
+            Client errors except 429 are not retried.
+        '''
+        start: float = time.perf_counter()
+        response = await self._get(url, headers)
+        if response is None:
+            result: str = "failed"
+        else:
+            result = "not_modified" if response.status_code == 304 else "ok"
+
+        http_seconds.observe(time.perf_counter() - start, result=result)
+
+        return response
+
+    async def _get(self, url: str, headers: Optional[Dict[str, str]]) -> Optional[httpx.Response]:
+        if self._client is None:
+            await self.startup()
+
+        for i in range(self._retries):
+            if i > 0:
+                await asyncio.sleep(self._delay(i - 1))
+
+            try:
+                async with self._semaphore:
+                    response = await self._client.get(url, headers=headers)
+
+                if response.status_code == 200 or response.status_code == 304:
+                    return response
+
+                logger.warning(
+                    f"Error occurred when downloading {url}: HTTP {response.status_code}, retry: {i+1}/{self._retries}")
+                if 400 <= response.status_code < 500 and response.status_code != 429:
+                    break
+
+            except Exception as e:
+                logger.warning(
+                    f"Error occurred when downloading {url}: {e!r}, retry: {i+1}/{self._retries}")
+
+        logger.warning(f"Abort downloading {url}")
+        return None
+
+    async def get_json(self, url: str) -> Optional[Any]:
+        response = await self.get(url)
+        if response is None:
+            return None
+
+        try:
+            return response.json()
+        except ValueError:
+            logger.warning(f"Invalid JSON from {url}")
+            return None
+
+    async def get_bytes(self, url: str) -> Optional[bytes]:
+        response = await self.get(url)
+
+        return None if response is None else response.content
+
+
+class Validators:
+    '''
+        ETag and Last-Modified of downloaded urls, persisted in a JSON file, so that after restarts
+        unchanged resources are answered with 304 Not Modified instead of the whole body.
+        Validators of a response are staged until the resource is applied, then committed.
+        Resources are updated concurrently and committed from executor threads, so it's locked.
+    '''
+
+    def __init__(self, _file: Path):
+        self._file: Path = _file
+        self._validators: Optional[Dict[str, Dict[str, str]]] = None
+        self._staged: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Dict[str, str]]:
+        if self._validators is None:
+            try:
+                self._validators = load_json(
+                    self._file) if self._file.exists() else {}
+            except ValueError:
+                logger.warning(
+                    f"{self._file.name} is broken, validators are dropped")
+                self._validators = {}
+
+        return self._validators
+
+    def headers(self, url: str) -> Dict[str, str]:
+        '''
+            Headers of a conditional request of the url
+        '''
+        with self._lock:
+            validators: Dict[str, str] = self._load().get(url, {})
+
+        headers: Dict[str, str] = {}
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "last_modified" in validators:
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        return headers
+
+    def stage(self, url: str, response: httpx.Response) -> None:
+        validators: Dict[str, str] = {}
+        if "ETag" in response.headers:
+            validators["etag"] = response.headers["ETag"]
+        if "Last-Modified" in response.headers:
+            validators["last_modified"] = response.headers["Last-Modified"]
+
+        with self._lock:
+            self._staged[url] = validators
+
+    def commit(self, url: str) -> None:
+        '''
+            The staged resource of the url is applied, save its validators if changed
+        '''
+        with self._lock:
+            validators: Optional[Dict[str, str]] = self._staged.pop(url, None)
+            cached: Dict[str, Dict[str, str]] = self._load()
+            if validators is None or cached.get(url, {}) == validators:
+                return
+
+            if validators:
+                cached[url] = validators
+            else:
+                cached.pop(url, None)
+
+            # Saved under the lock, so the file written last holds every commit
+            save_json(self._file, dict(cached))
@@ -0,0 +1,174 @@
+import random
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from nonebot import logger
+
+from .menu import Pool
+from .utils import load_json
+
+_MASK32: int = 0xFFFFFFFF
+
+
+def _mix(x: int) -> int:
+    '''
+        32-bit integer hash, good enough to key a round
+    '''
+    x = ((x ^ (x >> 16)) * 0x45D9F3B) & _MASK32
+    x = ((x ^ (x >> 16)) * 0x45D9F3B) & _MASK32
+
+    return x ^ (x >> 16)
+
+
+def permute(i: int, n: int, seed: int) -> int:
+    '''
+        The i-th element of a pseudorandom permutation of range(n) chosen by seed, in O(1) memory.
+        A 4-round Feistel network permutes the smallest domain of an even number of bits >= n,
+        and values out of range(n) are walked through it again. The domain is less than 4n,
+        so a walk takes less than 4 steps on average.
+    '''
+    half: int = max(1, ((n - 1).bit_length() + 1) // 2)
+    mask: int = (1 << half) - 1
+    keys: Tuple[int, ...] = tuple(
+        _mix(seed + r * 0x9E3779B9) for r in range(4))
+
+    x: int = i
+    while True:
+        left, right = x >> half, x & mask
+        for key in keys:
+            left, right = right, left ^ (_mix(right ^ key) & mask)
+
+        x = (left << half) | right
+        if x < n:
+            return x
+
+
+class ShuffleBags:
+    '''
+        No-repeat sampling of foods and drinks by key, e.g. a group or a user in a group.
+        Foods are drawn as a shuffle bag: every food of the pool is picked once, in the order of a
+        permutation by seed, before any is picked again. A bag is [seed, cursor, fingerprint],
+        the permutation is never materialized, so a bag is small and a pick is O(1).
+        A group's bag permutes the index space of its GroupPool, basic foods then the group's own.
+        Once the pool's fingerprint differs, i.e. the menu has changed, the bag starts a new round.
+        Drinks are weighted, so they can't be bagged; only the last drink of a key is avoided.
+
+        Bags live in the data of the storage as "bags", and bags changed since the last save are
+        saved through it as one change, e.g. one line of the journal. At most MAX_BAGS bags of
+        foods and of drinks are kept each, the least recently used are dropped.
+    '''
+
+    # Redraws of a drink equal to the last one
+    DRINK_RETRIES: int = 3
+    MAX_BAGS: int = 10000
+
+    def __init__(self):
+        # From least to most recently used
+        self._foods: Dict[str, List[int]] = {}
+        self._drinks: Dict[str, str] = {}
+        # Keys changed since the last save
+        self._changed_foods: Set[str] = set()
+        self._changed_drinks: Set[str] = set()
+
+    def bind(self, bags: Dict[str, Dict]) -> None:
+        '''
+            Use the bags in the data of the storage, e.g. reloaded, keeping the changes not saved yet
+        '''
+        foods: Dict[str, List[int]] = bags.setdefault("foods", {})
+        drinks: Dict[str, str] = bags.setdefault("drinks", {})
+        for key in self._changed_foods:
+            if key in self._foods:
+                foods[key] = self._foods[key]
+            else:
+                foods.pop(key, None)
+
+        for key in self._changed_drinks:
+            if key in self._drinks:
+                drinks[key] = self._drinks[key]
+            else:
+                drinks.pop(key, None)
+
+        self._foods, self._drinks = foods, drinks
+
+    def import_file(self, _file: Path) -> None:
+        '''
+            Take the bags of a JSON file, where versions before kept them, to be saved by the storage
+        '''
+        try:
+            _data: Dict[str, Dict] = load_json(_file)
+        except ValueError:
+            logger.warning(f"{_file.name} is broken, shuffle bags are dropped")
+            return
+
+        for key, bag in _data.get("foods", {}).items():
+            self._use(self._foods, self._changed_foods, key, bag)
+
+        for key, drink in _data.get("drinks", {}).items():
+            self._use(self._drinks, self._changed_drinks, key, drink)
+
+    def changes(self) -> Tuple[Dict[str, Optional[List[int]]], Dict[str, Optional[str]]]:
+        '''
+            Bags of foods and drinks changed since last called, None if dropped
+        '''
+        foods: Dict[str, Optional[List[int]]] = {
+            key: list(self._foods[key]) if key in self._foods else None for key in self._changed_foods}
+        drinks: Dict[str, Optional[str]] = {
+            key: self._drinks.get(key) for key in self._changed_drinks}
+        self._changed_foods = set()
+        self._changed_drinks = set()
+
+        return foods, drinks
+
+    def _use(self, bags: Dict[str, Any], changed: Set[str], key: str, value: Any) -> None:
+        '''
+            Put value of key as the most recently used, dropping the least recently used beyond MAX_BAGS
+        '''
+        bags.pop(key, None)
+        bags[key] = value
+        changed.add(key)
+
+        while len(bags) > self.MAX_BAGS:
+            oldest: str = next(iter(bags))
+            bags.pop(oldest)
+            changed.add(oldest)
+
+    def pick(self, key: str, pool: Pool) -> str:
+        '''
+            Pick a food of the non-empty pool
+        '''
+        n: int = len(pool)
+        fingerprint: int = pool.fingerprint()
+        bag: Optional[List[int]] = self._foods.get(key)
+
+        if bag is None or bag[2] != fingerprint:
+            bag = [random.getrandbits(32), 0, fingerprint]
+        elif bag[1] >= n:
+            # A new round shouldn't begin with the food ending the last one
+            last: int = permute(n - 1, n, bag[0])
+            seed: int = random.getrandbits(32)
+            while n > 1 and permute(0, n, seed) == last:
+                seed = random.getrandbits(32)
+
+            bag[0], bag[1] = seed, 0
+
+        food: str = pool[permute(bag[1], n, bag[0])]
+        bag[1] += 1
+        self._use(self._foods, self._changed_foods, key, bag)
+
+        return food
+
+    def pick_drink(self, key: str, pick: Callable[[], Tuple[str, str]]) -> Tuple[str, str]:
+        '''
+            Pick (brand, drink) by pick, other than the last one of key if possible
+        '''
+        last: Optional[str] = self._drinks.get(key)
+        brand, drink = pick()
+        for _ in range(self.DRINK_RETRIES):
+            if f"{brand}/{drink}" != last:
+                break
+
+            brand, drink = pick()
+
+        self._use(self._drinks, self._changed_drinks, key, f"{brand}/{drink}")
+
+        return brand, drink
@@ -0,0 +1,168 @@
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from nonebot import logger
+
+try:
+    import ujson as json
+except ModuleNotFoundError:
+    import json
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+try:
+    import msgpack
+except ModuleNotFoundError:
+    msgpack = None
+
+
+class Serializer:
+    '''
+        Encode data to bytes and back. suffix is the extension of the files it writes.
+    '''
+
+    name: str = ""
+    suffix: str = ".json"
+
+    def dumps(self, _data: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, _raw: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JsonSerializer(Serializer):
+    '''
+        ujson if installed, otherwise the standard json. Indented unless compact.
+    '''
+
+    name: str = "json"
+
+    def __init__(self, compact: bool = False):
+        self._compact: bool = compact
+
+    def dumps(self, _data: Any) -> bytes:
+        if self._compact:
+            _text: str = json.dumps(
+                _data, ensure_ascii=False, separators=(",", ":"))
+        else:
+            _text: str = json.dumps(_data, ensure_ascii=False, indent=4)
+
+        return _text.encode("utf-8")
+
+    def loads(self, _raw: bytes) -> Any:
+        return json.loads(_raw.decode("utf-8"))
+
+
+class OrjsonSerializer(Serializer):
+    '''
+        orjson writes UTF-8 bytes directly, and only supports an indent of 2
+    '''
+
+    name: str = "orjson"
+
+    def __init__(self, compact: bool = False):
+        self._option: int = 0 if compact else orjson.OPT_INDENT_2
+
+    def dumps(self, _data: Any) -> bytes:
+        return orjson.dumps(_data, option=self._option)
+
+    def loads(self, _raw: bytes) -> Any:
+        return orjson.loads(_raw)
+
+
+class MsgpackSerializer(Serializer):
+    '''
+        Binary, always compact. Files are named "*.msgpack" so they're never taken for JSON.
+    '''
+
+    name: str = "msgpack"
+    suffix: str = ".msgpack"
+
+    def dumps(self, _data: Any) -> bytes:
+        return msgpack.packb(_data, use_bin_type=True)
+
+    def loads(self, _raw: bytes) -> Any:
+        return msgpack.unpackb(_raw, raw=False, strict_map_key=False)
+
+
+_MODULES: Dict[str, Any] = {"orjson": orjson, "msgpack": msgpack}
+
+# Encode files that must stay JSON, e.g. resources and the export
+json_serializer: Serializer = JsonSerializer()
+# Encode data written by storages
+data_serializer: Serializer = json_serializer
+
+
+def get_serializer(name: str, compact: bool = False) -> Serializer:
+    '''
+        The serializer of name. Fall back to json if its package isn't installed.
+    '''
+    if name in _MODULES and _MODULES[name] is None:
+        logger.warning(f"Package {name} is not installed, fall back to json")
+        name = "json"
+
+    if name == "orjson":
+        return OrjsonSerializer(compact)
+    elif name == "msgpack":
+        return MsgpackSerializer()
+
+    return JsonSerializer(compact)
+
+
+def configure(name: str, compact: bool) -> None:
+    '''
+        Set the serializers used by utils. JSON files use the same library and compactness,
+        unless the data serializer is binary.
+    '''
+    global json_serializer, data_serializer
+
+    data_serializer = get_serializer(name, compact)
+    json_serializer = data_serializer if data_serializer.suffix == ".json" else \
+        JsonSerializer(compact)
+
+
+def serializer_of(_file: Path) -> Serializer:
+    '''
+        The serializer to read the file by its suffix
+    '''
+    if _file.suffix == ".msgpack":
+        if msgpack is None:
+            raise RuntimeError(
+                f"Package msgpack is required to read {_file.name}")
+
+        return data_serializer if data_serializer.suffix == ".msgpack" else MsgpackSerializer()
+
+    return json_serializer
+
+
+def data_file(_file: Path) -> Path:
+    '''
+        Where data of _file, e.g. "eating.json", is written by the data serializer
+    '''
+    return _file.with_suffix(data_serializer.suffix)
+
+
+def find_data(_file: Path) -> Optional[Path]:
+    '''
+        The latest modified file holding data of _file in any format, or None if none exists.
+        After switching serializers, the file last written wins over the stale one.
+    '''
+    found: Optional[Path] = None
+    mtime: float = -1
+
+    for suffix in (".json", ".msgpack"):
+        _path: Path = _file.with_suffix(suffix)
+        try:
+            _mtime: float = _path.stat().st_mtime
+        except FileNotFoundError:
+            continue
+
+        # Prefer the format in use on a tie
+        if _mtime > mtime or (_mtime == mtime and suffix == data_serializer.suffix):
+            found, mtime = _path, _mtime
+
+    return found
@@ -0,0 +1,947 @@
+import asyncio
+import os
+import sqlite3
+import uuid
+from pathlib import Path
+from typing import (Any, Callable, Dict, List, Optional, Set, TextIO, Tuple,
+                    TypeVar, Union)
+
+from nonebot import logger
+
+from .locking import FileLock
+from .metrics import journal_bytes
+from .serializer import data_file, find_data
+from .utils import Meals, dump_data, load_data, run_sync, save_data, write_file
+
+try:
+    import ujson as json
+except ModuleNotFoundError:
+    import json
+
+T = TypeVar("T")
+# Path, mtime and size of a file, None if missing
+_Stat = Optional[Tuple[str, int, int]]
+
+
+def apply_op(_eating: Dict, _greetings: Dict, op: List[Any]) -> str:
+    '''
+        Apply a change to the data, see JsonStorage for the ops. Return which data is changed,
+        "eating" or "greetings". Every op but "i" is idempotent, so applying it again is harmless.
+    '''
+    if op[0] == "i":
+        counts: Dict[str, List[int]] = _eating["count"].setdefault(op[1], {})
+        count: Any = counts.get(op[2])
+        if isinstance(count, list) and count[1] == op[3]:
+            counts[op[2]] = [count[0] + 1, op[3]]
+        else:
+            counts[op[2]] = [1, op[3]]
+    elif op[0] == "v":
+        _eating["version"] = op[1]
+    elif op[0] == "a" or op[0] == "r":
+        if op[1] is None:
+            foods: List[str] = _eating["basic_food"]
+        else:
+            foods: List[str] = _eating["group_food"].setdefault(op[1], [])
+
+        if op[0] == "a" and op[2] not in foods:
+            foods.append(op[2])
+        elif op[0] == "r" and op[2] in foods:
+            foods.remove(op[2])
+    elif op[0] == "A":
+        foods: List[str] = _eating["basic_food"] if op[1] is None else \
+            _eating["group_food"].setdefault(op[1], [])
+        present: Set[str] = set(foods)
+        for food in op[2]:
+            if food not in present:
+                present.add(food)
+                foods.append(food)
+    elif op[0] == "b":
+        for kind, changes in (("foods", op[1]), ("drinks", op[2])):
+            bags: Dict[str, Any] = _eating.setdefault(
+                "bags", {}).setdefault(kind, {})
+            for key, value in changes.items():
+                if value is None:
+                    bags.pop(key, None)
+                else:
+                    bags[key] = value
+    elif op[0] == "s":
+        if op[2]:
+            _greetings["groups_id"].update({op[1]: True})
+        else:
+            _greetings["groups_id"].pop(op[1], None)
+
+        return "greetings"
+    elif op[0] == "g":
+        _greetings[op[1]] = op[2]
+        return "greetings"
+
+    return "eating"
+
+
+def _stat(_file: Path) -> _Stat:
+    _path: Optional[Path] = find_data(_file)
+    if _path is None:
+        return None
+
+    st = _path.stat()
+
+    return str(_path), st.st_mtime_ns, st.st_size
+
+
+class Storage:
+    '''
+        Persistence of eating and greetings data.
+        EatingManager keeps the data resident in memory and reports every change here.
+        gid = None indicates the basic menu.
+
+        Blocking disk work runs in the thread executor, and writers of the same resource
+        are serialized by an asyncio lock, so changes reach the disk in the order they are made.
+
+        Several processes may share what2eat_path. Read-modify-write cycles on files take the
+        FileLock, and sync() swaps in data changed by others through on_reload.
+    '''
+
+    # Whether groups are loaded on demand by load_group, instead of all at once by load
+    lazy: bool = False
+
+    def __init__(self, file_lock: FileLock):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._file_lock: FileLock = file_lock
+        # Changes reported but not durable yet, applied again over the data reloaded meanwhile
+        self._pending: List[List[Any]] = []
+        # Called with the new eating and greetings data once reloaded by sync()
+        self.on_reload: Optional[Callable[[Dict, Dict], None]] = None
+
+    def _lock(self, resource: str) -> asyncio.Lock:
+        if resource not in self._locks:
+            self._locks[resource] = asyncio.Lock()
+
+        return self._locks[resource]
+
+    def _settle(self, op: List[Any]) -> None:
+        '''
+            The change is durable, drop it from pending by identity, as equal changes may be pending
+        '''
+        for i, pending in enumerate(self._pending):
+            if pending is op:
+                del self._pending[i]
+                return
+
+    async def _run(self, resource: str, func: Callable[..., T], *args: Any) -> T:
+        async with self._lock(resource):
+            return await run_sync(func, *args)
+
+    async def load(self) -> Tuple[Dict[str, Any], Dict[str, Union[List[str], Dict[str, bool]]]]:
+        '''
+            Return eating and greetings data
+        '''
+        raise NotImplementedError
+
+    async def load_group(self, gid: str) -> Tuple[List[str], Dict[str, List[int]]]:
+        '''
+            Return the menu and counts of a group, only for lazy storages
+        '''
+        raise NotImplementedError
+
+    async def unload_group(self, gid: str, foods: List[str], counts: Dict[str, List[int]]) -> None:
+        '''
+            The group is evicted from memory, write it back if changed
+        '''
+        pass
+
+    async def list_groups(self) -> List[str]:
+        '''
+            All the groups stored, only for lazy storages
+        '''
+        raise NotImplementedError
+
+    async def incr_count(self, gid: str, uid: str, epoch: int) -> None:
+        '''
+            Count the user once more in the meal window starting at epoch, from 1 if counted in
+            another window. Stored as an increment, so increments by other processes are kept.
+        '''
+        raise NotImplementedError
+
+    async def set_version(self, version: float) -> None:
+        '''
+            Version of the basic menu merged from repo
+        '''
+        raise NotImplementedError
+
+    async def add_food(self, gid: Optional[str], food: str) -> None:
+        raise NotImplementedError
+
+    async def add_foods(self, gid: Optional[str], foods: List[str]) -> None:
+        '''
+            Add foods at once, committed as one change
+        '''
+        raise NotImplementedError
+
+    async def remove_food(self, gid: Optional[str], food: str) -> None:
+        raise NotImplementedError
+
+    async def save_bags(self, foods: Dict[str, Optional[List[int]]], drinks: Dict[str, Optional[str]]) -> None:
+        '''
+            Shuffle bags changed since last saved, None if dropped, see ShuffleBags
+        '''
+        raise NotImplementedError
+
+    async def update_greeting_status(self, gid: str, new_state: bool) -> None:
+        raise NotImplementedError
+
+    async def add_greeting(self, meal: Meals, greeting: str) -> None:
+        raise NotImplementedError
+
+    async def remove_greeting(self, meal: Meals, index: int) -> None:
+        raise NotImplementedError
+
+    async def sync(self) -> None:
+        '''
+            Reload the data if changed by another process or edited by hand
+        '''
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        await self.flush()
+
+
+class JsonStorage(Storage):
+    '''
+        Keep eating.json and greetings.json as snapshots, written by the configured serializer,
+        e.g. as eating.msgpack by msgpack.
+        With a journal, every change is appended to it as one compact line, and flush() compacts
+        the journal into the snapshots. Without a journal, changes only mark the data dirty and
+        flush() writes the whole file back.
+
+        Journal lines:
+        - ["j", journal_id]                 first line, the snapshot the journal follows
+        - ["i", gid, uid, epoch]            count once more in the meal window
+        - ["v", version]                    version of the basic menu
+        - ["a", gid, food]                  add food, gid = null for the basic menu
+        - ["A", gid, foods]                 add foods at once
+        - ["r", gid, food]                  remove food
+        - ["b", foods, drinks]              shuffle bags changed by key, null if dropped
+        - ["s", gid, state]                 greeting status of a group
+        - ["g", meal, greetings]            all the greetings of a meal
+
+        Increments aren't idempotent, so a journal is never replayed over a snapshot taking it
+        in: flush() stamps eating.json with a new "journal_id" and starts the journal with it.
+        If a crash leaves the journal behind a newer snapshot, the ids differ and it's skipped.
+
+        Processes sharing the files append to the same journal under the FileLock, and the
+        snapshots plus the journal are the whole truth. If the snapshots or the journal are
+        changed by others, i.e. differ from what this process has seen, the data is reloaded
+        from them before flushing, or by sync().
+    '''
+
+    def __init__(self, eating_json: Path, greetings_json: Path, file_lock: FileLock, journal: Optional[Path] = None):
+        super().__init__(file_lock)
+        self._eating_json: Path = eating_json
+        self._greetings_json: Path = greetings_json
+        self._journal: Optional[Path] = journal
+        self._journal_file: Optional[TextIO] = None
+        self._eating: Dict = {}
+        self._greetings: Dict = {}
+        self._eating_dirty: bool = False
+        self._greetings_dirty: bool = False
+        # Snapshots and size of the journal as last seen, None before loaded
+        self._stats: Optional[Tuple[_Stat, _Stat]] = None
+        self._journal_size: int = 0
+        # Ids of pending changes taken in by the snapshots, never to be written to the journal
+        self._compacted: Set[int] = set()
+
+    def _read(self) -> Tuple[Dict, Dict, int]:
+        '''
+            Load the snapshots and replay the journal over them, under the FileLock.
+            Return the data and the number of changes replayed.
+        '''
+        _eating: Dict = load_data(self._eating_json)
+        _greetings: Dict = load_data(self._greetings_json)
+        replayed: int = 0
+        self._journal_size = 0
+
+        if self._journal is not None and self._journal.exists():
+            with self._journal.open("rb") as f:
+                for line in f:
+                    try:
+                        op: List[Any] = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        # The last line may be truncated by a crash
+                        logger.warning(
+                            f"Journal {self._journal.name} is broken at line {replayed + 1}, the rest is discarded")
+                        break
+
+                    if op[0] == "j":
+                        if op[1] != _eating.get("journal_id"):
+                            logger.warning(
+                                f"Journal {self._journal.name} is already in {self._eating_json.name}, skipped")
+                            break
+
+                        continue
+
+                    apply_op(_eating, _greetings, op)
+                    replayed += 1
+
+                self._journal_size = f.seek(0, 2)
+
+            if replayed > 0:
+                logger.info(
+                    f"Replayed {replayed} changes from journal {self._journal.name}")
+
+        self._stats = self._stat_snapshots()
+
+        return _eating, _greetings, replayed
+
+    def _stat_snapshots(self) -> Tuple[_Stat, _Stat]:
+        return _stat(self._eating_json), _stat(self._greetings_json)
+
+    def _is_stale(self) -> bool:
+        '''
+            Whether the files are changed by others since last seen, under the FileLock
+        '''
+        if self._stat_snapshots() != self._stats:
+            return True
+
+        return self._journal is not None and self._journal.exists() and \
+            self._journal.stat().st_size != self._journal_size
+
+    async def _reload(self) -> None:
+        '''
+            Under the FileLock and the journal lock, reload the data if stale.
+            Changes in neither the journal nor the snapshots yet are applied again, so none is
+            lost or counted twice by the swap.
+        '''
+        if not await run_sync(self._is_stale):
+            return
+
+        _eating, _greetings, replayed = await run_sync(self._read)
+        for op in self._pending:
+            if id(op) not in self._compacted:
+                apply_op(_eating, _greetings, op)
+
+        self._eating, self._greetings = _eating, _greetings
+        # The journal is compacted and changes pending are written by the next flush
+        if replayed > 0 or self._pending:
+            self._eating_dirty = True
+            self._greetings_dirty = True
+
+        logger.info(
+            f"Reloaded {self._eating_json.name} and {self._greetings_json.name} changed outside this process")
+        if self.on_reload is not None:
+            self.on_reload(_eating, _greetings)
+
+    async def load(self) -> Tuple[Dict, Dict]:
+        '''
+            Load the snapshots, then replay the journal over them and compact it
+        '''
+        async with self._file_lock:
+            self._eating, self._greetings, replayed = await run_sync(self._read)
+
+        self._pending.clear()
+        self._eating_dirty = replayed > 0
+        self._greetings_dirty = replayed > 0
+
+        if self._journal is not None:
+            await self.flush()
+            self._journal_file = await run_sync(self._journal.open, "a", encoding="utf-8", newline="\n")
+
+        return self._eating, self._greetings
+
+    def _write_journal(self, line: str) -> None:
+        _data: bytes = line.encode("utf-8")
+        with self._file_lock.hold():
+            if os.fstat(self._journal_file.fileno()).st_size != self._journal_size:
+                # Appended or truncated by others, never take it for ours
+                self._journal_size = -1
+
+            self._journal_file.write(line)
+            self._journal_file.flush()
+            if self._journal_size >= 0:
+                self._journal_size += len(_data)
+
+        journal_bytes.inc(len(_data))
+
+    def _truncate_journal(self, journal_id: Optional[str]) -> None:
+        # Truncated in place, as other processes may hold it open
+        if self._journal.exists():
+            os.truncate(self._journal, 0)
+
+        header: bytes = (json.dumps(["j", journal_id]) + "\n").encode("utf-8")
+        with self._journal.open("ab") as f:
+            f.write(header)
+
+        self._journal_size = len(header)
+
+    async def _append(self, op: List[Any]) -> None:
+        if op[0] == "s" or op[0] == "g":
+            self._greetings_dirty = True
+        else:
+            self._eating_dirty = True
+
+        # Without a journal, changes are pending until flushed
+        self._pending.append(op)
+        if self._journal_file is not None:
+            # Serialized now, the data may change before the line is written
+            line: str = json.dumps(
+                op, ensure_ascii=False, separators=(",", ":")) + "\n"
+            try:
+                async with self._lock("journal"):
+                    # Taken in by a flush meanwhile, the snapshots already count it
+                    if id(op) not in self._compacted:
+                        await run_sync(self._write_journal, line)
+            finally:
+                self._settle(op)
+                self._compacted.discard(id(op))
+
+    async def incr_count(self, gid: str, uid: str, epoch: int) -> None:
+        await self._append(["i", gid, uid, epoch])
+
+    async def set_version(self, version: float) -> None:
+        await self._append(["v", version])
+
+    async def add_food(self, gid: Optional[str], food: str) -> None:
+        await self._append(["a", gid, food])
+
+    async def add_foods(self, gid: Optional[str], foods: List[str]) -> None:
+        await self._append(["A", gid, list(foods)])
+
+    async def remove_food(self, gid: Optional[str], food: str) -> None:
+        await self._append(["r", gid, food])
+
+    async def save_bags(self, foods: Dict[str, Optional[List[int]]], drinks: Dict[str, Optional[str]]) -> None:
+        await self._append(["b", foods, drinks])
+
+    async def update_greeting_status(self, gid: str, new_state: bool) -> None:
+        await self._append(["s", gid, new_state])
+
+    async def add_greeting(self, meal: Meals, greeting: str) -> None:
+        await self._append(["g", meal.value[0], list(self._greetings[meal.value[0]])])
+
+    async def remove_greeting(self, meal: Meals, index: int) -> None:
+        await self._append(["g", meal.value[0], list(self._greetings[meal.value[0]])])
+
+    async def sync(self) -> None:
+        if self._stats is None:
+            return
+
+        async with self._lock("journal"):
+            async with self._file_lock:
+                await self._reload()
+
+    async def flush(self) -> None:
+        '''
+            Write the in-memory data back to disk if changed since the last flush, merged with
+            changes by others if any. The snapshots are taken at once and replaced atomically,
+            then the journal is truncated. Journal appends wait meanwhile, so changes after
+            the snapshots stay in the journal.
+        '''
+        async with self._lock("journal"):
+            async with self._file_lock:
+                await self._reload()
+
+                snapshots: List[Tuple[Path, bytes]] = []
+                if self._eating_dirty:
+                    if self._journal is not None:
+                        self._eating["journal_id"] = uuid.uuid4().hex
+                    snapshots.append(
+                        (data_file(self._eating_json), dump_data(self._eating)))
+                    self._eating_dirty = False
+
+                if self._greetings_dirty:
+                    snapshots.append(
+                        (data_file(self._greetings_json), dump_data(self._greetings)))
+                    self._greetings_dirty = False
+
+                # Changes made from now on are left pending
+                written: int = len(self._pending)
+
+                for _file, _data in snapshots:
+                    await self._run(_file.name, write_file, _file, _data)
+
+                if self._journal is not None:
+                    await run_sync(self._truncate_journal, self._eating.get("journal_id"))
+                    self._compacted.update(id(op)
+                                           for op in self._pending[:written])
+                else:
+                    del self._pending[:written]
+
+                self._stats = await run_sync(self._stat_snapshots)
+
+    async def close(self) -> None:
+        await self.flush()
+
+        if self._journal_file is not None:
+            await run_sync(self._journal_file.close)
+            self._journal_file = None
+
+
+class SqliteStorage(Storage):
+    '''
+        Store menus, counters and greetings in a SQLite database in WAL mode.
+        Every change is a single statement, e.g. one UPSERT for a count increment.
+        On first use, eating.json and greetings.json are migrated into the database.
+        The connection is only used by one executor thread at a time, under the lock of "db".
+        SQLite locks the database among processes itself. Commits of other processes change
+        "PRAGMA data_version", then sync() reloads the data.
+    '''
+
+    _SCHEMA: str = '''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS foods (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            gid TEXT NOT NULL DEFAULT '',
+            food TEXT NOT NULL,
+            UNIQUE (gid, food)
+        );
+        CREATE TABLE IF NOT EXISTS groups (
+            gid TEXT PRIMARY KEY,
+            greeting INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS counts (
+            gid TEXT NOT NULL,
+            uid TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            epoch INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (gid, uid)
+        );
+        CREATE TABLE IF NOT EXISTS greetings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            meal TEXT NOT NULL,
+            greeting TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_greetings_meal ON greetings (meal);
+        CREATE TABLE IF NOT EXISTS food_bags (
+            key TEXT PRIMARY KEY,
+            seed INTEGER NOT NULL,
+            cursor INTEGER NOT NULL,
+            fingerprint INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS drink_bags (
+            key TEXT PRIMARY KEY,
+            drink TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, db_file: Path, eating_json: Path, greetings_json: Path, file_lock: FileLock):
+        super().__init__(file_lock)
+        self._db_file: Path = db_file
+        self._eating_json: Path = eating_json
+        self._greetings_json: Path = greetings_json
+        self._conn: Optional[sqlite3.Connection] = None
+        self._greetings: Dict = {}
+        self._data_version: int = 0
+
+    def _open(self) -> None:
+        self._conn = sqlite3.connect(self._db_file, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self._SCHEMA)
+
+        # Databases created before counters were tagged with epochs
+        if "epoch" not in [row[1] for row in self._conn.execute("PRAGMA table_info (counts)")]:
+            self._conn.execute(
+                "ALTER TABLE counts ADD COLUMN epoch INTEGER NOT NULL DEFAULT 0")
+
+        # Processes starting together must not migrate twice
+        with self._file_lock.hold():
+            self._migrate()
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str) -> None:
+        self._conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value", (key, value))
+
+    def _migrate(self) -> None:
+        '''
+            One-shot migration from eating.json and greetings.json.
+            Afterwards only a newer "basic_food" in eating.json, e.g. auto updated, is merged.
+        '''
+        migrated: bool = self._get_meta("migrated") is not None
+        _eating = load_data(self._eating_json) if find_data(
+            self._eating_json) else {}
+
+        with self._conn:
+            if not migrated:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO foods (gid, food) VALUES ('', ?)", ((food,) for food in _eating.get("basic_food", [])))
+
+                for gid, foods in _eating.get("group_food", {}).items():
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO foods (gid, food) VALUES (?, ?)", ((gid, food) for food in foods))
+
+                # Counts without epoch, from versions before, are stale
+                for gid, counts in _eating.get("count", {}).items():
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO counts (gid, uid, count, epoch) VALUES (?, ?, ?, ?)",
+                        ((gid, uid, *(count if isinstance(count, list) else [count, 0])) for uid, count in counts.items()))
+
+                if find_data(self._greetings_json):
+                    _greetings = load_data(self._greetings_json)
+                    for meal in Meals:
+                        self._conn.executemany(
+                            "INSERT INTO greetings (meal, greeting) VALUES (?, ?)", ((meal.value[0], greeting) for greeting in _greetings.get(meal.value[0], [])))
+
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO groups (gid, greeting) VALUES (?, 1)", ((gid,) for gid in _greetings.get("groups_id", {})))
+
+                self._set_meta("version", str(_eating.get("version", 0)))
+                self._set_meta("migrated", "1")
+                logger.info(
+                    "Migrated eating.json and greetings.json to SQLite")
+
+            elif _eating.get("version", 0) > float(self._get_meta("version") or 0):
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO foods (gid, food) VALUES ('', ?)", ((food,) for food in _eating.get("basic_food", [])))
+                self._set_meta("version", str(_eating["version"]))
+
+    async def load(self) -> Tuple[Dict, Dict]:
+        return await self._run("db", self._load)
+
+    def _load(self) -> Tuple[Dict, Dict]:
+        if self._conn is None:
+            self._open()
+
+        self._data_version = self._get_data_version()
+        self._greetings = self._load_greetings()
+
+        return self._load_eating(), self._greetings
+
+    def _get_data_version(self) -> int:
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _reload(self) -> Optional[Tuple[Dict, Dict]]:
+        if self._conn is None or self._get_data_version() == self._data_version:
+            return None
+
+        return self._load()
+
+    async def sync(self) -> None:
+        async with self._lock("db"):
+            data: Optional[Tuple[Dict, Dict]] = await run_sync(self._reload)
+            if data is None:
+                return
+
+            # Changes waiting for the lock aren't in the database yet
+            for op in self._pending:
+                apply_op(*data, op)
+
+        logger.info("Reloaded data changed by another process from SQLite")
+        if self.on_reload is not None:
+            self.on_reload(*data)
+
+    def _load_eating(self) -> Dict:
+        _eating: Dict = {
+            "version": float(self._get_meta("version") or 0),
+            "basic_food": [],
+            "group_food": {},
+            "count": {}
+        }
+
+        for gid, food in self._conn.execute("SELECT gid, food FROM foods ORDER BY id"):
+            if gid == "":
+                _eating["basic_food"].append(food)
+            else:
+                _eating["group_food"].setdefault(gid, []).append(food)
+
+        for gid, uid, count, epoch in self._conn.execute("SELECT gid, uid, count, epoch FROM counts"):
+            _eating["count"].setdefault(gid, {})[uid] = [count, epoch]
+
+        _eating["bags"] = {
+            "foods": {key: [seed, cursor, fingerprint] for key, seed, cursor, fingerprint in
+                      self._conn.execute("SELECT key, seed, cursor, fingerprint FROM food_bags")},
+            "drinks": dict(self._conn.execute("SELECT key, drink FROM drink_bags"))
+        }
+
+        return _eating
+
+    def _load_greetings(self) -> Dict:
+        _greetings: Dict = {meal.value[0]: [] for meal in Meals}
+
+        for meal, greeting in self._conn.execute("SELECT meal, greeting FROM greetings ORDER BY id"):
+            _greetings.setdefault(meal, []).append(greeting)
+
+        _greetings["groups_id"] = {
+            gid: True for gid, in self._conn.execute("SELECT gid FROM groups WHERE greeting = 1")}
+
+        return _greetings
+
+    def _execute(self, sql: str, parameters: Any = (), many: bool = False) -> None:
+        with self._conn:
+            if many:
+                self._conn.executemany(sql, parameters)
+            else:
+                self._conn.execute(sql, parameters)
+
+    async def _write(self, op: List[Any], sql: str, parameters: Any = (), many: bool = False) -> None:
+        '''
+            Execute a change in a transaction, op is the same change as in the journal of JsonStorage
+        '''
+        await self._write_by(op, self._execute, sql, parameters, many)
+
+    async def _write_by(self, op: List[Any], func: Callable[..., None], *args: Any) -> None:
+        '''
+            Make a change by func, for changes of more than one statement
+        '''
+        self._pending.append(op)
+        try:
+            await self._run("db", func, *args)
+        finally:
+            self._settle(op)
+
+    def _save_bags(self, foods: Dict[str, Optional[List[int]]], drinks: Dict[str, Optional[str]]) -> None:
+        with self._conn:
+            self._conn.executemany("DELETE FROM food_bags WHERE key = ?",
+                                   ((key,) for key, bag in foods.items() if bag is None))
+            self._conn.executemany(
+                "INSERT INTO food_bags (key, seed, cursor, fingerprint) VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET seed = excluded.seed, cursor = excluded.cursor, fingerprint = excluded.fingerprint",
+                ((key, *bag) for key, bag in foods.items() if bag is not None))
+            self._conn.executemany("DELETE FROM drink_bags WHERE key = ?",
+                                   ((key,) for key, drink in drinks.items() if drink is None))
+            self._conn.executemany(
+                "INSERT INTO drink_bags (key, drink) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET drink = excluded.drink",
+                ((key, drink) for key, drink in drinks.items() if drink is not None))
+
+    async def incr_count(self, gid: str, uid: str, epoch: int) -> None:
+        await self._write(["i", gid, uid, epoch],
+                          "INSERT INTO counts (gid, uid, count, epoch) VALUES (?, ?, 1, ?) ON CONFLICT (gid, uid) DO UPDATE SET count = CASE WHEN epoch = excluded.epoch THEN count + 1 ELSE 1 END, epoch = excluded.epoch", (gid, uid, epoch))
+
+    async def set_version(self, version: float) -> None:
+        await self._write(["v", version],
+                          "INSERT INTO meta (key, value) VALUES ('version', ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value", (str(version),))
+
+    async def add_food(self, gid: Optional[str], food: str) -> None:
+        await self._write(["a", gid, food],
+                          "INSERT OR IGNORE INTO foods (gid, food) VALUES (?, ?)", (gid or "", food))
+
+    async def add_foods(self, gid: Optional[str], foods: List[str]) -> None:
+        await self._write(["A", gid, list(foods)],
+                          "INSERT OR IGNORE INTO foods (gid, food) VALUES (?, ?)", [(gid or "", food) for food in foods], many=True)
+
+    async def remove_food(self, gid: Optional[str], food: str) -> None:
+        await self._write(["r", gid, food],
+                          "DELETE FROM foods WHERE gid = ? AND food = ?", (gid or "", food))
+
+    async def save_bags(self, foods: Dict[str, Optional[List[int]]], drinks: Dict[str, Optional[str]]) -> None:
+        await self._write_by(["b", foods, drinks], self._save_bags, foods, drinks)
+
+    async def update_greeting_status(self, gid: str, new_state: bool) -> None:
+        await self._write(["s", gid, new_state],
+                          "INSERT INTO groups (gid, greeting) VALUES (?, ?) ON CONFLICT (gid) DO UPDATE SET greeting = excluded.greeting", (gid, int(new_state)))
+
+    async def add_greeting(self, meal: Meals, greeting: str) -> None:
+        await self._write(["g", meal.value[0], list(self._greetings[meal.value[0]])],
+                          "INSERT INTO greetings (meal, greeting) VALUES (?, ?)", (meal.value[0], greeting))
+
+    async def remove_greeting(self, meal: Meals, index: int) -> None:
+        '''
+            Remove the index-th (from 1) greeting of the meal, the same order as shown
+        '''
+        await self._write(["g", meal.value[0], list(self._greetings[meal.value[0]])],
+                          "DELETE FROM greetings WHERE id = (SELECT id FROM greetings WHERE meal = ? ORDER BY id LIMIT 1 OFFSET ?)", (meal.value[0], index - 1))
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._run("db", self._conn.close)
+            self._conn = None
+
+
+class ShardStorage(Storage):
+    '''
+        Keep the basic menu and each group in their own shard files under shards/:
+        - basic.json: version and basic_food
+        - groups/<gid>.json: food and count of the group
+        - bags.json: shuffle bags
+        greetings.json stays as it is. All are written by the configured serializer, e.g. as
+        basic.msgpack by msgpack.
+
+        Groups are loaded on first access and may be evicted from memory by EatingManager, so
+        the cost of a change depends on the size of the one group involved. Changes mark their
+        shard dirty, and flush() only writes the dirty shards back.
+        On first use, eating.json is split into shards.
+        Groups in memory aren't shared among processes, so only one process may use the shards.
+    '''
+
+    lazy: bool = True
+
+    def __init__(self, shard_dir: Path, eating_json: Path, greetings_json: Path, file_lock: FileLock):
+        super().__init__(file_lock)
+        self._shard_dir: Path = shard_dir
+        self._eating_json: Path = eating_json
+        self._greetings_json: Path = greetings_json
+        self._eating: Dict = {}
+        self._greetings: Dict = {}
+        # Dirty shards, None for the basic shard
+        self._dirty: Set[Optional[str]] = set()
+        self._greetings_dirty: bool = False
+        self._bags_dirty: bool = False
+
+    @property
+    def _basic_file(self) -> Path:
+        return self._shard_dir / "basic.json"
+
+    @property
+    def _bags_file(self) -> Path:
+        return self._shard_dir / "bags.json"
+
+    def _read_bags(self) -> Dict:
+        return load_data(self._bags_file) if find_data(self._bags_file) else {"foods": {}, "drinks": {}}
+
+    def _group_file(self, gid: str) -> Path:
+        return self._shard_dir / "groups" / f"{gid}.json"
+
+    def _migrate(self) -> None:
+        '''
+            One-shot split of eating.json into shards.
+            Afterwards only a newer "basic_food" in eating.json, e.g. auto updated, is merged.
+        '''
+        _eating: Dict = load_data(self._eating_json) if find_data(
+            self._eating_json) else {}
+
+        if find_data(self._basic_file):
+            _basic: Dict = load_data(self._basic_file)
+            if _eating.get("version", 0) > _basic.get("version", 0):
+                local_set: Set[str] = set(_basic["basic_food"])
+                _basic["basic_food"] += [food for food in _eating.get("basic_food", [])
+                                         if food not in local_set]
+                _basic["version"] = _eating["version"]
+                save_data(self._basic_file, _basic)
+
+            return
+
+        (self._shard_dir / "groups").mkdir(parents=True, exist_ok=True)
+        group_food: Dict[str, List[str]] = _eating.get("group_food", {})
+        count: Dict[str, Dict] = _eating.get("count", {})
+
+        for gid in set(group_food) | set(count):
+            # Counts without epoch, from versions before, are stale
+            save_data(self._group_file(gid), {
+                "food": group_food.get(gid, []),
+                "count": {uid: c if isinstance(c, list) else [c, 0] for uid, c in count.get(gid, {}).items()}
+            })
+
+        # Written at last, so an interrupted split is started over
+        save_data(self._basic_file, {
+            "version": _eating.get("version", 0),
+            "basic_food": _eating.get("basic_food", [])
+        })
+        logger.info(
+            f"Split eating.json into shards of the basic menu and {len(set(group_food) | set(count))} groups")
+
+    async def load(self) -> Tuple[Dict, Dict]:
+        '''
+            Load the basic shard and greetings, groups are loaded by load_group
+        '''
+        async with self._file_lock:
+            await self._run("basic", self._migrate)
+        _basic: Dict = await self._run("basic", load_data, self._basic_file)
+        self._greetings = await self._run(self._greetings_json.name, load_data, self._greetings_json)
+        self._eating = {
+            "version": _basic.get("version", 0),
+            "basic_food": _basic.get("basic_food", []),
+            "group_food": {},
+            "count": {},
+            "bags": await self._run("bags", self._read_bags)
+        }
+        self._dirty.clear()
+        self._greetings_dirty = False
+        self._bags_dirty = False
+
+        return self._eating, self._greetings
+
+    def _read_group(self, gid: str) -> Dict:
+        _file: Path = self._group_file(gid)
+
+        return load_data(_file) if find_data(_file) else {}
+
+    async def load_group(self, gid: str) -> Tuple[List[str], Dict[str, List[int]]]:
+        _group: Dict = await self._run(f"group:{gid}", self._read_group, gid)
+
+        return _group.get("food", []), _group.get("count", {})
+
+    async def _write_group(self, gid: str, foods: List[str], counts: Dict[str, List[int]]) -> None:
+        # Dumped now and the lock is taken before any other write, so writes keep their order
+        _data: bytes = dump_data({"food": foods, "count": counts})
+        await self._run(f"group:{gid}", write_file, data_file(self._group_file(gid)), _data)
+
+    async def unload_group(self, gid: str, foods: List[str], counts: Dict[str, List[int]]) -> None:
+        if gid in self._dirty:
+            self._dirty.discard(gid)
+            await self._write_group(gid, foods, counts)
+
+    def _list_groups(self) -> List[str]:
+        _group_dir: Path = self._shard_dir / "groups"
+        if not _group_dir.exists():
+            return []
+
+        # A group may have shards of both formats after switching serializers
+        return sorted({f.stem for f in _group_dir.iterdir() if f.suffix in (".json", ".msgpack")})
+
+    async def list_groups(self) -> List[str]:
+        return await run_sync(self._list_groups)
+
+    async def incr_count(self, gid: str, uid: str, epoch: int) -> None:
+        self._dirty.add(gid)
+
+    async def set_version(self, version: float) -> None:
+        self._dirty.add(None)
+
+    async def add_food(self, gid: Optional[str], food: str) -> None:
+        self._dirty.add(gid)
+
+    async def add_foods(self, gid: Optional[str], foods: List[str]) -> None:
+        self._dirty.add(gid)
+
+    async def remove_food(self, gid: Optional[str], food: str) -> None:
+        self._dirty.add(gid)
+
+    async def save_bags(self, foods: Dict[str, Optional[List[int]]], drinks: Dict[str, Optional[str]]) -> None:
+        self._bags_dirty = True
+
+    async def update_greeting_status(self, gid: str, new_state: bool) -> None:
+        self._greetings_dirty = True
+
+    async def add_greeting(self, meal: Meals, greeting: str) -> None:
+        self._greetings_dirty = True
+
+    async def remove_greeting(self, meal: Meals, index: int) -> None:
+        self._greetings_dirty = True
+
+    async def flush(self) -> None:
+        '''
+            Write the dirty shards back, each replaced atomically
+        '''
+        for gid in list(self._dirty):
+            # A group stays dirty until its turn, so if evicted meanwhile, unload_group writes it
+            if gid not in self._dirty:
+                continue
+
+            self._dirty.discard(gid)
+            if gid is None:
+                _data: bytes = dump_data({
+                    "version": self._eating.get("version", 0),
+                    "basic_food": self._eating["basic_food"]
+                })
+                await self._run("basic", write_file, data_file(self._basic_file), _data)
+            elif gid in self._eating["group_food"]:
+                await self._write_group(gid, self._eating["group_food"][gid], self._eating["count"].get(gid, {}))
+
+        if self._greetings_dirty:
+            self._greetings_dirty = False
+            _data: bytes = dump_data(self._greetings)
+            await self._run(self._greetings_json.name, write_file, data_file(self._greetings_json), _data)
+
+        if self._bags_dirty:
+            self._bags_dirty = False
+            _data: bytes = dump_data(self._eating["bags"])
+            await self._run("bags", write_file, data_file(self._bags_file), _data)
@@ -1,16 +1,16 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta
 from enum import Enum
+from functools import partial
 from pathlib import Path
-from typing import Any, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
 
-import aiofiles
-import httpx
-from nonebot import logger
-from nonebot.adapters.onebot.v11 import Message, MessageSegment
+from . import serializer
+from .metrics import json_bytes, json_seconds
 
-try:
-    import ujson as json
-except ModuleNotFoundError:
-    import json
+T = TypeVar("T")
 
 
 class Meals(Enum):
@@ -51,81 +51,131 @@ DrinkingEnough_List: List[str] = [
 ]
 
 
-def save_json(_file: Path, _data: Any) -> None:
-    with open(_file, 'w', encoding='utf-8') as f:
-        json.dump(_data, f, ensure_ascii=False, indent=4)
+def get_meal_window(reset_hours: List[int], now: Optional[datetime] = None) -> Tuple[int, int]:
+    '''
+        Return the start and end timestamps of the meal window that now is in.
+        Windows are split at reset_hours of every day, e.g. [6, 11, 17, 22].
+    '''
+    if now is None:
+        now = datetime.now()
 
+    hours: List[int] = sorted(set(reset_hours)) or [0]
+    today: datetime = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    boundaries: List[datetime] = [today - timedelta(days=1) + timedelta(hours=hours[-1])] + \
+        [today + timedelta(hours=h) for h in hours] + \
+        [today + timedelta(days=1, hours=hours[0])]
 
-def load_json(_file: Path) -> Any:
-    with open(_file, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    start: datetime = max(b for b in boundaries if b <= now)
+    end: datetime = min(b for b in boundaries if b > now)
+
+    return int(start.timestamp()), int(end.timestamp())
+
+
+# Kinds of files by name without the serializer's suffix, the "file" label of metrics
+_FILE_KINDS: Dict[str, str] = {
+    "eating": "eating",
+    "greetings": "greetings",
+    "drinks": "drinks",
+    "basic": "basic_shard",
+    "bags": "bags",
+    "what2eat.bags": "bags",
+    "sizes": "image_sizes",
+    "what2eat.validators": "validators"
+}
+
+
+def file_kind(_file: Path) -> str:
+    '''
+        Label of the file in metrics, one of a fixed set however many group shards there are
+    '''
+    if _file.parent.name == "groups":
+        return "group_shard"
+    if _file.parent.name == "export":
+        return "export"
 
+    return _FILE_KINDS.get(_file.stem, "other")
 
-async def get_image_from_url(url: str) -> Optional[bytes]:
-    async with httpx.AsyncClient() as client:
-        for i in range(3):
-            try:
-                resp = await client.get(url)
-                if resp.status_code != 200:
-                    continue
 
-                return resp.content
+def dump_json(_data: Any) -> bytes:
+    with json_seconds.time(op="dump"):
+        return serializer.json_serializer.dumps(_data)
 
-            except Exception:
-                logger.warning(
-                    f"Error occurred when downloading {url}, retry: {i+1}/3")
 
-    logger.warning(f"Download image failed: {url}")
-    return None
+def dump_data(_data: Any) -> bytes:
+    '''
+        Encode data of storages by the configured serializer, see data_file()
+    '''
+    with json_seconds.time(op="dump"):
+        return serializer.data_serializer.dumps(_data)
 
 
-async def save_image(_img: bytes, _path: Path) -> None:
-    async with aiofiles.open(_path, "wb") as f:
-        await f.write(_img)
+def temp_file(_file: Path) -> Path:
+    '''
+        A temp file next to _file to write then rename, unique to each writer: processes may share
+        the directory, and threads or coroutines of a process may write the same file at once
+    '''
+    return _file.with_name(f"{_file.name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
 
 
-async def save_cq_image(msg: Message, img_dir: Path) -> None:
-    for msg_seg in msg:
-        if msg_seg.type == "image":
-            filename = msg_seg.data.get("file", False)
-            if filename is False:
-                continue
+def write_file(_file: Path, _data: bytes) -> None:
+    '''
+        Write to a temp file then rename it, a crash never leaves a truncated file
+    '''
+    _tmp: Path = temp_file(_file)
+    with json_seconds.time(op="write", file=file_kind(_file)):
+        with open(_tmp, 'wb') as f:
+            f.write(_data)
+            f.flush()
+            os.fsync(f.fileno())
 
-            # Check whether there is a same name image
-            images: List[str] = [
-                f.name for f in img_dir.iterdir() if f.is_file()]
-            filepath: Path = img_dir / filename
+        os.replace(_tmp, _file)
+
+    json_bytes.inc(len(_data), op="write", file=file_kind(_file))
+
+
+def save_json(_file: Path, _data: Any) -> None:
+    write_file(_file, dump_json(_data))
+
+
+def load_json(_file: Path) -> Any:
+    '''
+        Load the file, decoded by its suffix, i.e. msgpack for "*.msgpack" and JSON otherwise
+    '''
+    with json_seconds.time(op="load", file=file_kind(_file)):
+        _raw: bytes = _file.read_bytes()
+        _data: Any = serializer.serializer_of(_file).loads(_raw)
 
-            if filename not in images:
-                url = msg_seg.data.get("url", False)
-                if url is False:
-                    continue
+    json_bytes.inc(len(_raw), op="load", file=file_kind(_file))
 
-                data = await get_image_from_url(url)
-                if not data:
-                    continue
+    return _data
 
-                await save_image(data, filepath)
 
-            msg_seg.data["file"] = MessageSegment.image(filepath)
+def save_data(_file: Path, _data: Any) -> Path:
+    '''
+        Save data of _file, e.g. "eating.json", by the configured serializer. Return the file written.
+    '''
+    _path: Path = serializer.data_file(_file)
+    write_file(_path, dump_data(_data))
 
+    return _path
 
-def delete_cq_image(str_cq: str) -> bool:
-    _start: int = str_cq.find("file://")
-    if _start == -1:
-        return False
 
-    _end: int = str_cq.find(".image")
-    if _end == -1:
-        return False
+def load_data(_file: Path) -> Any:
+    '''
+        Load data of _file from the latest written format, see find_data()
+    '''
+    _path: Optional[Path] = serializer.find_data(_file)
+    if _path is None:
+        raise FileNotFoundError(_file)
 
-    delete_path: Path = Path(str_cq[_start + 7: _end + 6])
-    if not delete_path.is_file():
-        return False
+    return load_json(_path)
 
-    delete_path.unlink()
 
-    return not delete_path.is_file()
+async def run_sync(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    '''
+        Run blocking work, e.g. disk I/O, in the default thread executor
+    '''
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
 
 
 def get_cq_image_path(str_cq: str) -> str: